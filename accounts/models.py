@@ -47,6 +47,7 @@ class CustomUser(AbstractUser):
     first_name = models.CharField(max_length=150)
     last_name = models.CharField(max_length=150)
     avatar = models.ImageField(upload_to='users_avatars/', default='users_avatars/placeholder.png')
+    avatar_variants = models.JSONField(default=dict, blank=True)
     role = models.CharField(
         max_length=2,
         choices=RoleChoices.choices,
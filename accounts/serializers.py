@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model, authenticate
+from market.images import variant_urls
 from .models import VerificationCode
 
 User = get_user_model()
@@ -99,10 +100,15 @@ class ResetPasswordConfirmSerializer(serializers.Serializer):
 
 
 class GetUserInfoSerialzer(serializers.ModelSerializer):
+    avatar_variants = serializers.SerializerMethodField()
+
     class Meta:
         model = User
-        fields = ('id', 'email', 'avatar', 'first_name', 'last_name','telegram_id', 'role')
+        fields = ('id', 'email', 'avatar', 'avatar_variants', 'first_name', 'last_name','telegram_id', 'role')
         read_only_fields = ('id', 'email', 'role', 'telegram_id', 'avatar')
+
+    def get_avatar_variants(self, obj):
+        return variant_urls(obj.avatar, obj.avatar_variants, self.context.get('request'))
     
 
 
@@ -11,8 +11,7 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 import asyncio
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Count, Avg, DecimalField, F
-from django.db.models.functions import Coalesce
+from django.db.models import Count, F
 from asgiref.sync import sync_to_async
 
 from aiogram import Dispatcher, Bot, F as AF, types
@@ -80,7 +79,6 @@ class DB:
     @sync_to_async
     def get_shop_info(user):
         return Shop.objects.annotate(
-            avg_crowns=Coalesce(Avg('products__product_crowns__crowns'), 0, output_field=DecimalField()),
             total_products=Count('products', distinct=True),
             total_orders=Count('products__orders', distinct=True)
         ).select_related('seller').filter(seller=user).first()
@@ -88,10 +86,10 @@ class DB:
     @staticmethod
     @sync_to_async
     def get_last_products_with_images(user):
-        products = Product.objects.filter(shop__seller=user).order_by('-created_at')[:10]
+        products = Product.objects.filter(shop__seller=user).select_related('main_image').order_by('-created_at')[:10]
         result = []
         for prod in products:
-            image_obj = prod.images.filter(is_main_image=True).first()
+            image_obj = prod.main_image
             if not image_obj:
                 image_obj = prod.images.first()
             
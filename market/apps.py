@@ -7,3 +7,9 @@ class MarketConfig(AppConfig):
 
     def ready(self):
         import market.signals
+        from django.core.signals import request_started
+        from django.db.models.signals import post_migrate
+        from market.search import ensure_index
+        from market.suggest import suggest_index
+        post_migrate.connect(ensure_index, sender=self)
+        request_started.connect(suggest_index.warm, dispatch_uid='warm_suggest_index')
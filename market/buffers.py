@@ -0,0 +1,108 @@
+import abc
+import atexit
+import threading
+
+from django.db import DatabaseError, close_old_connections, connection
+
+
+class WriteBehindBuffer(abc.ABC):
+    """Collects rows in memory and hands them to ``write`` in batches.
+
+    A batch is written once ``max_size`` items are pending or
+    ``flush_interval`` seconds after the first one, whichever comes first.
+    Whatever is still pending when the process exits is flushed by an
+    ``atexit`` hook.
+    """
+
+    def __init__(self, max_size=200, flush_interval=5.0):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+        atexit.register(self.flush)
+
+    def _push(self, item):
+        # Called with the lock held; returns a batch if this item filled it.
+        self.pending.append(item)
+        if len(self.pending) < self.max_size:
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self._flush_from_timer)
+                self.timer.daemon = True
+                self.timer.start()
+            return None
+        return self._take()
+
+    def flush(self):
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self.write(batch)
+
+    def _take(self):
+        batch, self.pending = self.pending, []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
+
+    def _flush_from_timer(self):
+        close_old_connections()
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    @abc.abstractmethod
+    def write(self, batch):
+        """Stores one batch; runs in the request or timer thread that took it."""
+
+
+class HistoryBuffer(WriteBehindBuffer):
+    """Write-behind buffer for search history.
+
+    Repeating the previous query of the same user is not recorded, and after
+    every flush only the newest ``per_user_limit`` rows of the users involved
+    are kept.
+    """
+
+    def __init__(self, per_user_limit=100, remembered_users=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.per_user_limit = per_user_limit
+        self.remembered_users = remembered_users
+        self.last_query = {}
+
+    def add(self, user_id, text):
+        with self.lock:
+            if self.last_query.get(user_id) == text:
+                return
+            if len(self.last_query) >= self.remembered_users:
+                self.last_query.clear()
+            self.last_query[user_id] = text
+            batch = self._push((user_id, text))
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        from .models import HistorySearch
+
+        try:
+            HistorySearch.objects.bulk_create(
+                [HistorySearch(user_id=user_id, text=text) for user_id, text in batch]
+            )
+            for user_id in {user_id for user_id, _ in batch}:
+                self._trim(user_id)
+        except DatabaseError as error:
+            # Losing a few history rows is better than failing a search.
+            print(f"Search history error: {error}")
+
+    def _trim(self, user_id):
+        from .models import HistorySearch
+
+        oldest_kept = (HistorySearch.objects.filter(user_id=user_id).order_by('-id')
+                       .values_list('id', flat=True)[self.per_user_limit - 1:self.per_user_limit].first())
+        if oldest_kept is not None:
+            HistorySearch.objects.filter(user_id=user_id, id__lt=oldest_kept).delete()
+
+
+history_buffer = HistoryBuffer()
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from array import array
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+
+# Every cached payload is stored under a key that embeds the current version of
+# each tag it depends on. Invalidating a tag bumps its version, so all keys
+# built from the old version simply stop being read and age out on their own.
+# Versions live in the shared cache, which is what makes this work across
+# worker processes.
+TAG_KEY = 'tag:{}'
+DEFAULT_TIMEOUT = 60
+
+# Entries outlive their TTL by STALE_TTL so that, while one worker rebuilds an
+# expired entry, everybody else keeps getting the previous payload.
+STALE_TTL = 300
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 2.0
+LOCK_POLL = 0.05
+# XFetch: the closer an entry gets to its TTL, and the longer it took to
+# compute, the more likely a reader refreshes it early.
+EARLY_REFRESH_BETA = 1.0
+
+STATS_KEY = 'cache_stats:{}:{}'
+STATS_EVENTS = ('hit', 'miss', 'stale', 'rebuild', 'rejected')
+
+
+def _tag_key(tag):
+    return TAG_KEY.format(tag)
+
+
+def _fresh_version():
+    # A tag that was evicted must never restart at a version that an old,
+    # still cached payload was built with.
+    return int(time.time() * 1000)
+
+
+def tag_versions(tags):
+    keys = [_tag_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            version = _fresh_version()
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+            versions[key] = version
+    return [versions[key] for key in keys]
+
+
+def _parts_digest(parts):
+    return hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def make_key(name, tags, parts=()):
+    versions = '.'.join(str(version) for version in tag_versions(tags))
+    suffix = f':{_parts_digest(parts)}' if parts else ''
+    return f'{name}:{versions}{suffix}'
+
+
+def get_or_set(name, tags, compute, parts=(), timeout=DEFAULT_TIMEOUT, admission=None, key=None):
+    key = key or make_key(name, tags, parts)
+    entry = cache.get(key)
+    if entry is not None and not _needs_refresh(entry):
+        _record(name, 'hit')
+        return entry['value']
+    _record(name, 'miss')
+
+    # The admission filter only guards the first write of a key: an entry that
+    # made it in keeps being refreshed like any other.
+    if entry is None and admission is not None and not admission.admit(f'{name}:{_parts_digest(parts)}'):
+        _record(name, 'rejected')
+        return compute()
+
+    lock_key = f'lock:{key}'
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            return _rebuild(name, key, compute, timeout)
+        finally:
+            cache.delete(lock_key)
+
+    if entry is not None:
+        _record(name, 'stale')
+        return entry['value']
+
+    # Cold key and somebody else is already building it: wait for their result
+    # rather than running the same query in parallel.
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL)
+        entry = cache.get(key)
+        if entry is not None:
+            _record(name, 'hit')
+            return entry['value']
+    return _rebuild(name, key, compute, timeout)
+
+
+def cached_response(request, name, tags, compute, parts=(), **kwargs):
+    """``get_or_set`` wrapped in a conditional GET.
+
+    The ETag is a hash of the payload, stored next to it when it is built,
+    so a matching ``If-None-Match`` is answered with a 304 straight from the
+    cache. It is weak because the same payload renders differently per
+    format.
+    """
+    def build():
+        value = compute()
+        body = json.dumps(value, cls=JSONEncoder, sort_keys=True).encode()
+        return {'value': value, 'etag': f'W/"{hashlib.md5(body).hexdigest()}"'}
+
+    entry = get_or_set(name, tags, build, parts, **kwargs)
+    response = get_conditional_response(request, etag=entry['etag'])
+    if response is None:
+        response = Response(entry['value'])
+    response['ETag'] = entry['etag']
+    return response
+
+
+def _needs_refresh(entry):
+    now = time.time()
+    return now - entry['delta'] * EARLY_REFRESH_BETA * math.log(1.0 - random.random()) >= entry['expires']
+
+
+def _rebuild(name, key, compute, timeout):
+    started = time.time()
+    value = compute()
+    finished = time.time()
+    entry = {'value': value, 'expires': finished + timeout, 'delta': finished - started}
+    cache.set(key, entry, timeout + STALE_TTL)
+    _record(name, 'rebuild')
+    return value
+
+
+def _record(name, event):
+    key = STATS_KEY.format(name, event)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def stats(names):
+    keys = {(name, event): STATS_KEY.format(name, event) for name in names for event in STATS_EVENTS}
+    counts = cache.get_many(list(keys.values()))
+    return {
+        name: {event: counts.get(keys[(name, event)], 0) for event in STATS_EVENTS}
+        for name in names
+    }
+
+
+class FrequencySketch:
+    """TinyLFU-style admission filter.
+
+    A 4-bit count-min sketch of how often each key was requested. Counters are
+    halved every ``sample_size`` increments, so old popularity fades out and
+    the sketch keeps tracking what is being requested now.
+    """
+
+    def __init__(self, width=1 << 14, depth=4, sample_size=10 * (1 << 14), threshold=2):
+        self.width = width
+        self.depth = depth
+        self.sample_size = sample_size
+        self.threshold = threshold
+        self.rows = [array('B', bytes(width)) for _ in range(depth)]
+        self.additions = 0
+        self.lock = threading.Lock()
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'little') % self.width for i in range(self.depth)]
+
+    def increment(self, key):
+        indexes = self._indexes(key)
+        with self.lock:
+            estimate = 15
+            for row, index in zip(self.rows, indexes):
+                if row[index] < 15:
+                    row[index] += 1
+                estimate = min(estimate, row[index])
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self._age()
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def admit(self, key):
+        return self.increment(key) >= self.threshold
+
+    def _age(self):
+        self.rows = [array('B', row.tobytes().translate(_HALVE)) for row in self.rows]
+        self.additions //= 2
+
+
+_HALVE = bytes(value >> 1 for value in range(256))
+
+
+# Search result pages are only cached once their query has been seen before,
+# so one-off long-tail searches stop pushing popular ones out of the cache.
+# The sketch is per process; each worker learns the popular queries from the
+# share of traffic it serves.
+search_admission = FrequencySketch()
+
+
+def invalidate(*tags):
+    for tag in set(tags):
+        key = _tag_key(tag)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), None)
+
+
+def invalidate_on_commit(*tags):
+    # Bumping before the commit would let a concurrent reader cache the old
+    # rows again under the new version.
+    transaction.on_commit(lambda: invalidate(*tags))
+
+
+def product_tags(product):
+    return [f'product:{product.pk}', f'shop:{product.shop_id}', f'category:{product.category_id}']
@@ -0,0 +1,127 @@
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .buffers import WriteBehindBuffer
+from .models import CounterRecount, Product, ReviewProduct, ReviewShop, Shop
+
+
+BATCH_SIZE = 500
+# Queued counters are recounted at most once per interval, whichever worker
+# flushes first after it elapsed does it.
+FOLD_INTERVAL = 60
+FOLD_LOCK = 'lock:fold_counters'
+
+# kind -> (counted model, counter column, unique viewer model, its foreign key)
+COUNTERS = {
+    CounterRecount.Kind.PRODUCT_VIEWS: (Product, 'views_count', ReviewProduct, 'product'),
+    CounterRecount.Kind.SHOP_REVIEWS: (Shop, 'review_count', ReviewShop, 'shop'),
+}
+
+
+def _chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def queue_recount(kind, object_ids):
+    # Only marks the counters; an object already queued costs a skipped insert.
+    for chunk in _chunks(object_ids):
+        CounterRecount.objects.bulk_create(
+            [CounterRecount(kind=kind, object_id=object_id) for object_id in chunk], ignore_conflicts=True
+        )
+
+
+def fold_counters(force=False):
+    """Recounts the viewers of every queued object; returns how many were recounted.
+
+    The counters are set from the review rows instead of adding up what each
+    worker inserted, so two workers that inserted the same viewer can't
+    count it twice.
+    """
+    if not force and not cache.add(FOLD_LOCK, 1, FOLD_INTERVAL):
+        return 0
+    with transaction.atomic():
+        queued = list(CounterRecount.objects.select_for_update().values_list('id', 'kind', 'object_id'))
+        touched = defaultdict(set)
+        for _, kind, object_id in queued:
+            touched[kind].add(object_id)
+        for kind, object_ids in touched.items():
+            model, field, review_model, review_field = COUNTERS[kind]
+            viewers = (review_model.objects.filter(**{review_field: OuterRef('pk')}).order_by()
+                       .values(review_field).annotate(total=Count('id')).values('total'))
+            for chunk in _chunks(object_ids):
+                model.objects.filter(pk__in=chunk).update(**{field: Coalesce(Subquery(viewers), 0)})
+        for chunk in _chunks(pk for pk, _, _ in queued):
+            CounterRecount.objects.filter(pk__in=chunk).delete()
+    return len(queued)
+
+
+def rebuild_view_counts(batch_size=1000):
+    rebuilt = {}
+    with transaction.atomic():
+        CounterRecount.objects.all().delete()
+        for kind, (model, field, review_model, review_field) in COUNTERS.items():
+            model.objects.exclude(**{field: 0}).update(**{field: 0})
+            rows = (review_model.objects.order_by().values(f'{review_field}_id')
+                    .annotate(total=Count('id')).values_list(f'{review_field}_id', 'total'))
+            objects = [model(pk=pk, **{field: total}) for pk, total in rows]
+            model.objects.bulk_update(objects, [field], batch_size=batch_size)
+            rebuilt[kind] = len(objects)
+    return rebuilt
+
+
+class ViewBuffer(WriteBehindBuffer):
+    """Write-behind recorder of unique viewers.
+
+    Detail pages only add ``(object_id, user_id)`` to an in-memory set. A
+    flush inserts the review rows that do not exist yet and queues their
+    objects for a recount, which ``fold_counters`` runs periodically. Pairs
+    seen recently are remembered so repeat visits cost nothing at all.
+    """
+
+    def __init__(self, kind, known_limit=100000, **kwargs):
+        super().__init__(**kwargs)
+        self.kind = kind
+        self.known_limit = known_limit
+        self.known = set()
+
+    def add(self, user_id, object_id):
+        key = (object_id, user_id)
+        with self.lock:
+            if key in self.known:
+                return
+            if len(self.known) >= self.known_limit:
+                self.known.clear()
+            self.known.add(key)
+            batch = self._push(key)
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        review_model, review_field = COUNTERS[self.kind][2:]
+        column = f'{review_field}_id'
+        pairs = set(batch)
+        try:
+            existing = set(review_model.objects.filter(**{
+                f'{column}__in': {object_id for object_id, _ in pairs},
+                'user_id__in': {user_id for _, user_id in pairs},
+            }).values_list(column, 'user_id'))
+            new = pairs - existing
+            review_model.objects.bulk_create(
+                [review_model(**{column: object_id, 'user_id': user_id}) for object_id, user_id in new],
+                ignore_conflicts=True,
+            )
+            queue_recount(self.kind, {object_id for object_id, _ in new})
+            fold_counters()
+        except DatabaseError as error:
+            # A lost view is not worth failing anything for.
+            print(f"View counter error for {self.kind.label}: {error}")
+
+
+product_views = ViewBuffer(CounterRecount.Kind.PRODUCT_VIEWS, max_size=500, flush_interval=10.0)
+shop_views = ViewBuffer(CounterRecount.Kind.SHOP_REVIEWS, max_size=500, flush_interval=10.0)
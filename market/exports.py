@@ -0,0 +1,89 @@
+import csv
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import OrderItem
+
+
+CHUNK_SIZE = 2000
+ORDER_ITEM_COLUMNS = (
+    'order_id', 'order_created_at', 'status', 'buyer_id', 'buyer_email', 'buyer_name',
+    'item_id', 'shop_id', 'product_id', 'product_title', 'quantity', 'price_at_purchase', 'line_total',
+)
+
+
+def parse_moment(value, end=False):
+    """ISO date or datetime; a bare date as ``end`` means the end of that day."""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        if end:
+            day += datetime.timedelta(days=1)
+        moment = datetime.datetime.combine(day, datetime.time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, datetime.timezone.utc)
+    return moment
+
+
+def order_items(shop_id=None, created_after=None, created_before=None):
+    queryset = OrderItem.objects.select_related('order__user', 'product').only(
+        'id', 'quantity', 'price_at_purchase',
+        'order__id', 'order__status', 'order__created_at',
+        'order__user__id', 'order__user__email', 'order__user__first_name', 'order__user__last_name',
+        'product__id', 'product__title', 'product__shop_id',
+    ).order_by('order_id', 'id')
+    if shop_id is not None:
+        queryset = queryset.filter(product__shop_id=shop_id)
+    if created_after is not None:
+        queryset = queryset.filter(order__created_at__gte=created_after)
+    if created_before is not None:
+        queryset = queryset.filter(order__created_at__lt=created_before)
+    return queryset
+
+
+def order_item_rows(queryset):
+    # iterator() streams the rows in chunks instead of caching the whole
+    # result on the queryset.
+    for item in queryset.iterator(chunk_size=CHUNK_SIZE):
+        order, user, product = item.order, item.order.user, item.product
+        yield (
+            order.id, order.created_at, order.status, user.id, user.email,
+            f'{user.first_name} {user.last_name}'.strip(),
+            item.id, product.shop_id, product.id, product.title, item.quantity,
+            item.price_at_purchase, item.price_at_purchase * item.quantity,
+        )
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _joined(lines, rows_per_chunk=500):
+    # One write per few hundred rows rather than one per row.
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= rows_per_chunk:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def stream_csv(rows, columns=ORDER_ITEM_COLUMNS):
+    writer = csv.writer(_Echo())
+    lines = (writer.writerow([value.isoformat() if isinstance(value, datetime.datetime) else value
+                              for value in row]) for row in rows)
+    yield writer.writerow(columns)
+    yield from _joined(lines)
+
+
+def stream_ndjson(rows, columns=ORDER_ITEM_COLUMNS):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    yield from _joined(encoder.encode(dict(zip(columns, row))) + '\n' for row in rows)
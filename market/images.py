@@ -0,0 +1,224 @@
+import functools
+import io
+import multiprocessing
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .storage import release, retain
+
+
+# Largest first: each variant is shrunk from the previous one.
+VARIANTS = (('full', 1600), ('card', 480), ('thumb', 160))
+FORMATS = {
+    'WEBP': ('webp', {'quality': 80, 'method': 4}),
+    'JPEG': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def variant_format():
+    return getattr(settings, 'IMAGE_VARIANT_FORMAT', 'WEBP')
+
+
+def variant_name(name, variant, image_format):
+    root, _ = os.path.splitext(name)
+    return f'{root}.{variant}.{FORMATS[image_format][0]}'
+
+
+def render_variants(data, image_format):
+    """Returns ``{variant: encoded bytes}`` for an uploaded image.
+
+    Runs in a worker process. The variants are re-encoded from pixels only,
+    so EXIF (including GPS), XMP and ICC metadata of the upload are dropped;
+    the EXIF orientation is applied first so nothing ends up sideways.
+    """
+    options = FORMATS[image_format][1]
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (VARIANTS[0][1], VARIANTS[0][1]))
+        image = ImageOps.exif_transpose(image)
+        keep_alpha = image_format != 'JPEG' and (image.mode in ('RGBA', 'LA') or 'transparency' in image.info)
+        image = image.convert('RGBA' if keep_alpha else 'RGB')
+    image.info = {}
+    rendered = {}
+    for variant, size in VARIANTS:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **options)
+        rendered[variant] = buffer.getvalue()
+    return rendered
+
+
+def variant_urls(field_file, variants, request=None):
+    """``{'original': url, 'full': url, 'card': url, 'thumb': url}`` for an image field.
+
+    Only the original is listed until the variants of the current file have
+    been generated.
+    """
+    if not field_file:
+        return None
+
+    def absolute(url):
+        return request.build_absolute_uri(url) if request else url
+
+    urls = {'original': absolute(field_file.url)}
+    if variants and variants.get('source') == field_file.name:
+        urls.update({variant: absolute(field_file.storage.url(variants[variant]))
+                     for variant, _ in VARIANTS if variant in variants})
+    return urls
+
+
+@functools.cache
+def image_sources():
+    from django.contrib.auth import get_user_model
+
+    from .models import Category, ImageProduct, Shop
+
+    # model: (image field, variants field)
+    return {
+        ImageProduct: ('image', 'variants'),
+        Shop: ('avatar', 'avatar_variants'),
+        Category: ('avatar', 'avatar_variants'),
+        get_user_model(): ('avatar', 'avatar_variants'),
+    }
+
+
+def stored_files(name, variants):
+    """Every file an image field and its recorded variants point to."""
+    names = [name] if name else []
+    if variants and variants.get('source') == name:
+        names.extend(variants[variant] for variant, _ in VARIANTS if variant in variants)
+    return names
+
+
+def instance_files(instance):
+    """``stored_files`` of a loaded row, or None if its image fields were deferred."""
+    image_field, variants_field = image_sources()[type(instance)]
+    values = instance.__dict__
+    if image_field not in values or variants_field not in values:
+        return None
+    value = values[image_field]
+    return stored_files(getattr(value, 'name', value), values[variants_field])
+
+
+def needs_variants(instance):
+    fields = image_sources().get(type(instance))
+    if fields is None:
+        return False
+    field_file, variants = getattr(instance, fields[0]), getattr(instance, fields[1])
+    return bool(field_file) and (variants or {}).get('source') != field_file.name
+
+
+def generate_variants(model, pk, render=render_variants, retry_failed=False):
+    """Writes the variants of one row's image next to it and records them.
+
+    A file shared by several rows (like the default avatar, or any upload
+    stored once by ContentAddressedStorage) is only rendered once. A file
+    that can't be rendered (missing, or not an image) is recorded as
+    ``{'source': name, 'failed': True}`` so later saves don't queue it again;
+    ``retry_failed`` tries those once more.
+    """
+    image_field, variants_field = image_sources()[model]
+    instance = model.objects.filter(pk=pk).only(image_field, variants_field).first()
+    field_file = getattr(instance, image_field, None)
+    if not field_file:
+        return False
+    name, storage, image_format = field_file.name, field_file.storage, variant_format()
+    previous = getattr(instance, variants_field)
+
+    variants = (model.objects.filter(**{image_field: name, f'{variants_field}__source': name}).exclude(pk=pk)
+                .values_list(variants_field, flat=True).first())
+    if variants is not None and variants.get('failed') and retry_failed:
+        variants = None
+    if variants is None:
+        try:
+            with field_file.open('rb') as fp:
+                data = fp.read()
+            rendered = render(data, image_format)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            model.objects.filter(pk=pk, **{image_field: name}).update(
+                **{variants_field: {'source': name, 'failed': True}})
+            raise
+        # The storage names each variant by its content, so rendering the same
+        # source again stores nothing new.
+        variants = {'source': name, **{
+            variant: storage.save(variant_name(name, variant, image_format), ContentFile(content))
+            for variant, content in rendered.items()
+        }}
+
+    # Skipped if the image was replaced meanwhile; its own job records it.
+    if not model.objects.filter(pk=pk, **{image_field: name}).update(**{variants_field: variants}):
+        return False
+    before, after = Counter(stored_files(name, previous)), Counter(stored_files(name, variants))
+    retain(list((after - before).elements()))
+    release(list((before - after).elements()))
+    return True
+
+
+def variant_tags(model, pk):
+    from .models import Category, ImageProduct, Product, Shop
+
+    if model is ImageProduct:
+        product = Product.objects.filter(images=pk).values_list('id', 'shop_id').first()
+        if product is None:
+            return []
+        return [f'product:{product[0]}', f'shop:{product[1]}', 'product_list']
+    if model is Shop:
+        return [f'shop:{pk}', 'shop_list']
+    if model is Category:
+        return [f'category:{pk}', 'category_list']
+    return []
+
+
+class VariantPipeline:
+    """Generates image variants in the background.
+
+    A couple of threads read the uploads and store the results, while the
+    decoding and encoding runs in a process pool so it neither holds the
+    GIL of the web process nor is limited to one core.
+    """
+
+    def __init__(self, processes=None, threads=2):
+        self.processes = processes
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.process_pool = None
+        self.thread_pool = None
+
+    def _pools(self):
+        with self.lock:
+            if self.process_pool is None:
+                processes = self.processes or getattr(settings, 'IMAGE_VARIANT_PROCESSES', 2)
+                # spawn: forking a threaded web worker is not safe.
+                self.process_pool = ProcessPoolExecutor(max_workers=processes,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+                self.thread_pool = ThreadPoolExecutor(max_workers=self.threads)
+            return self.process_pool, self.thread_pool
+
+    def _render(self, data, image_format):
+        return self.process_pool.submit(render_variants, data, image_format).result()
+
+    def enqueue(self, model, pk):
+        _, thread_pool = self._pools()
+        thread_pool.submit(self._run, model, pk)
+
+    def _run(self, model, pk):
+        from django.db import close_old_connections, connection
+
+        from .caching import invalidate
+
+        close_old_connections()
+        try:
+            if generate_variants(model, pk, render=self._render):
+                invalidate(*variant_tags(model, pk))
+        except Exception as error:
+            print(f"Image variant error for {model.__name__} {pk}: {error}")
+        finally:
+            connection.close()
+
+
+variant_pipeline = VariantPipeline()
@@ -0,0 +1,155 @@
+import codecs
+import csv
+import json
+
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import as_serializer_error
+
+from . import caching, search, stats
+from .models import Category, Product
+from .serializer import ProductImportRowSerializer
+from .suggest import suggest_index
+
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.json': 'ndjson'}
+
+
+def read_rows(upload):
+    """Yields ``(row number, row)`` from a CSV or NDJSON upload, line by line.
+
+    The format is picked from the file extension; ``row`` is None for an
+    NDJSON line that is not a JSON object.
+    """
+    name = (upload.name or '').lower()
+    kind = next((kind for suffix, kind in FORMATS.items() if name.endswith(suffix)), None)
+    if kind is None:
+        raise ValueError('Upload a .csv or .ndjson file.')
+    lines = codecs.iterdecode(upload, 'utf-8-sig', errors='replace')
+    if kind == 'csv':
+        return _csv_rows(lines)
+    return _ndjson_rows(lines)
+
+
+def _csv_rows(lines):
+    for number, row in enumerate(csv.DictReader(lines), start=1):
+        # Empty cells mean "not given", not an empty value.
+        yield number, {key.strip(): value for key, value in row.items() if key and value != ''}
+
+
+def _ndjson_rows(lines):
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+class ProductImport:
+    """Creates and updates a shop's products from validated rows.
+
+    Rows are validated and written ``chunk_size`` at a time, each chunk with
+    one ``bulk_create``, one ``bulk_update`` and the matching search index
+    writes in a single transaction. Bulk writes skip model signals, so the
+    suggest index is patched per chunk and the caches are invalidated once
+    when the import is done.
+    """
+
+    def __init__(self, shop, chunk_size=CHUNK_SIZE):
+        self.shop = shop
+        self.chunk_size = chunk_size
+        self.categories = set(Category.objects.filter(is_deleted=False).values_list('id', flat=True))
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+        self.updated_ids = set()
+
+    def run(self, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._import_chunk(chunk)
+        if self.created:
+            stats.refresh_products(self.shop.pk)
+        if self.created or self.updated:
+            caching.invalidate('product_list', f'shop:{self.shop.pk}',
+                               *[f'product:{pk}' for pk in self.updated_ids])
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+    def _error(self, number, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': number, 'errors': errors})
+
+    def _validate(self, chunk):
+        # One serializer validates every row: building its fields per row
+        # would cost more than the validation itself.
+        serializer = ProductImportRowSerializer()
+        valid = []
+        for number, row in chunk:
+            if row is None:
+                self._error(number, {'non_field_errors': ['Expected a JSON object.']})
+                continue
+            try:
+                data = dict(serializer.run_validation(row))
+            except ValidationError as error:
+                self._error(number, as_serializer_error(error))
+                continue
+            if 'category' in data and data['category'] not in self.categories:
+                self._error(number, {'category': ['Unknown category.']})
+                continue
+            valid.append((number, data))
+        return valid
+
+    def _import_chunk(self, chunk):
+        valid = self._validate(chunk)
+        ids = [data['id'] for _, data in valid if 'id' in data]
+        existing = Product.objects.filter(shop=self.shop, is_deleted=False).in_bulk(ids) if ids else {}
+
+        new, changed, fields = [], {}, set()
+        for number, data in valid:
+            pk = data.pop('id', None)
+            if 'category' in data:
+                data['category_id'] = data.pop('category')
+            if pk is None:
+                new.append(Product(shop=self.shop, **data))
+                continue
+            product = existing.get(pk)
+            if product is None:
+                self._error(number, {'id': ['No such product in your shop.']})
+                continue
+            for field, value in data.items():
+                setattr(product, field, value)
+            fields.update(data)
+            changed[pk] = product
+
+        now = timezone.now()
+        for product in changed.values():
+            product.updated_at = now
+        with transaction.atomic():
+            Product.objects.bulk_create(new)
+            if changed:
+                Product.objects.bulk_update(changed.values(), [*fields, 'updated_at'])
+            search.index_products(new + list(changed.values()))
+
+        suggest_index.update_products(new + list(changed.values()))
+        self.created += len(new)
+        self.updated += len(changed)
+        self.updated_ids.update(changed)
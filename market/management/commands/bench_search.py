@@ -0,0 +1,117 @@
+import itertools
+import random
+import sqlite3
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from market import search
+
+
+PRODUCT_DDL = (
+    "CREATE TABLE market_product (id INTEGER PRIMARY KEY, title TEXT, description TEXT, "
+    "price NUMERIC, category_id INTEGER, is_deleted BOOLEAN)"
+)
+
+FTS_QUERY = (
+    f"SELECT market_product.id FROM market_product, {search.FTS_TABLE} "
+    f"WHERE {search.FTS_TABLE}.rowid = market_product.id AND {search.FTS_TABLE} MATCH ? "
+    f"AND market_product.is_deleted = 0 AND market_product.category_id = ? "
+    f"AND market_product.price BETWEEN ? AND ? "
+    f"ORDER BY {search.FTS_TABLE}.rank LIMIT 21"
+)
+
+SCAN_QUERY = (
+    "SELECT id FROM market_product WHERE (title LIKE ? OR description LIKE ?) "
+    "AND is_deleted = 0 AND category_id = ? AND price BETWEEN ? AND ? "
+    "ORDER BY id DESC LIMIT 21"
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks product full-text search against the old icontains scan on a synthetic "
+        "catalog in a scratch SQLite database (the project database is not touched)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='Comma separated catalog sizes to measure')
+        parser.add_argument('--queries', type=int, default=200, help='Queries per size')
+        parser.add_argument('--scan-limit', type=int, default=100000,
+                            help='Largest catalog on which the icontains scan is also timed')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        vocabulary = self._vocabulary(rnd, 20000)
+        weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+
+        db = sqlite3.connect(':memory:')
+        db.execute(PRODUCT_DDL)
+        for statement in search.FTS_SCHEMA:
+            db.execute(statement)
+
+        loaded = 0
+        for size in sorted(int(s) for s in options['sizes'].split(',')):
+            started = time.perf_counter()
+            self._load(db, rnd, vocabulary, weights, loaded, size)
+            loaded = size
+            self.stdout.write(f"{size:>9} products loaded in {time.perf_counter() - started:.1f}s")
+
+            queries = [self._query(rnd, vocabulary, weights) for _ in range(options['queries'])]
+            matches = [
+                db.execute(f"SELECT count(*) FROM {search.FTS_TABLE} WHERE {search.FTS_TABLE} MATCH ?",
+                           [search.build_match(text)]).fetchone()[0]
+                for text, _, _, _ in queries
+            ]
+            self.stdout.write(f"    median full-text matches per query: {statistics.median(matches):.0f}")
+            self._report('fts', db, FTS_QUERY, [
+                (search.build_match(text), category, low, high) for text, category, low, high in queries
+            ])
+            if size <= options['scan_limit']:
+                self._report('icontains', db, SCAN_QUERY, [
+                    (f'%{text}%', f'%{text}%', category, low, high) for text, category, low, high in queries
+                ])
+
+    def _vocabulary(self, rnd, size):
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        words = set()
+        while len(words) < size:
+            words.add(''.join(rnd.choice(letters) for _ in range(rnd.randint(4, 9))))
+        return sorted(words)
+
+    def _load(self, db, rnd, vocabulary, weights, start, stop, batch_size=50000):
+        for offset in range(start, stop, batch_size):
+            rows = []
+            for pk in range(offset + 1, min(offset + batch_size, stop) + 1):
+                title = ' '.join(rnd.choices(vocabulary, cum_weights=weights, k=3))
+                description = ' '.join(rnd.choices(vocabulary, cum_weights=weights, k=20))
+                rows.append((pk, title, description, rnd.randint(1, 2000), rnd.randint(1, 50), 0))
+            db.executemany("INSERT INTO market_product VALUES (?, ?, ?, ?, ?, ?)", rows)
+            db.executemany(
+                f"INSERT INTO {search.FTS_TABLE}(rowid, title, description) VALUES (?, ?, ?)",
+                [row[:3] for row in rows],
+            )
+        db.execute(f"INSERT INTO {search.FTS_TABLE}({search.FTS_TABLE}) VALUES ('optimize')")
+        db.commit()
+
+    def _query(self, rnd, vocabulary, weights):
+        # Real searches are mostly one or two specific words: skip the head of
+        # the Zipf curve that behaves like a stop word.
+        words = rnd.choices(vocabulary[50:], cum_weights=weights[50:], k=rnd.choice([1, 1, 2]))
+        low = rnd.randint(1, 1000)
+        return ' '.join(words), rnd.randint(1, 50), low, low + 1000
+
+    def _report(self, label, db, sql, params):
+        timings = []
+        for args in params:
+            started = time.perf_counter()
+            db.execute(sql, args).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(
+            f"    {label:<10} median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms"
+        )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from market import recommendations
+
+
+class Command(BaseCommand):
+    help = "Updates the frequently-bought-together neighbours from orders placed since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Drop the stored counts and rebuild them from every order')
+        parser.add_argument('--top', type=int, default=recommendations.TOP_K,
+                            help='Neighbours kept per product')
+        parser.add_argument('--min-count', type=int, default=recommendations.MIN_COUNT,
+                            help='Ignore pairs bought together in fewer orders than this')
+        parser.add_argument('--max-basket', type=int, default=recommendations.MAX_BASKET,
+                            help='Skip orders with more distinct products than this')
+
+    def handle(self, *args, **options):
+        builder = recommendations.RecommendationBuilder(
+            k=options['top'], min_count=options['min_count'], max_basket=options['max_basket'],
+        )
+        orders, products = builder.run(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(f"Processed {orders} orders, updated neighbours of {products} products"))
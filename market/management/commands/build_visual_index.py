@@ -0,0 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from market import visual
+from market.models import ImageProduct
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the image similarity index (run it periodically, e.g. nightly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true',
+                            help='First describe product images that have no descriptor yet')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Threads decoding images during --backfill')
+        parser.add_argument('--lists', type=int, default=None,
+                            help='Number of IVF lists (default: about 4 * sqrt(images))')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            missing = list(ImageProduct.objects.filter(descriptor__isnull=True).exclude(image='')
+                           .values_list('id', flat=True))
+            batches = [missing[start:start + 200] for start in range(0, len(missing), 200)]
+            # Pillow releases the GIL while decoding, so threads do overlap.
+            with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+                described = sum(pool.map(self._describe, batches))
+            self.stdout.write(f"Described {described} of {len(missing)} images")
+        total = visual.build_index(nlist=options['lists'])
+        self.stdout.write(self.style.SUCCESS(f"Visual index built with {total} images"))
+
+    def _describe(self, image_ids):
+        from django.db import connection
+
+        try:
+            return visual.describe_images(image_ids)
+        finally:
+            connection.close()
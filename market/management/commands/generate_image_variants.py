@@ -0,0 +1,48 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from market import caching, images
+
+
+class Command(BaseCommand):
+    help = "Generates missing thumb/card/full variants of product images and avatars"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='Worker processes encoding images')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also retry images whose variants could not be rendered before')
+
+    def handle(self, *args, **options):
+        with ProcessPoolExecutor(max_workers=options['processes'],
+                                 mp_context=multiprocessing.get_context('spawn')) as pool, \
+                ThreadPoolExecutor(max_workers=options['processes']) as threads:
+
+            def render(data, image_format):
+                return pool.submit(images.render_variants, data, image_format).result()
+
+            def generate(job):
+                model, pk = job
+                try:
+                    if not images.generate_variants(model, pk, render=render,
+                                                   retry_failed=options['retry_failed']):
+                        return False
+                    caching.invalidate(*images.variant_tags(model, pk))
+                    return True
+                except Exception as error:
+                    self.stderr.write(f"{model.__name__} {pk}: {error}")
+                    return False
+                finally:
+                    connection.close()
+
+            for model, (image_field, variants_field) in images.image_sources().items():
+                rows = model.objects.values_list('pk', image_field, variants_field).iterator(chunk_size=2000)
+                jobs = [(model, pk) for pk, name, variants in rows
+                        if name and ((variants or {}).get('source') != name
+                                     or (options['retry_failed'] and variants.get('failed')))]
+                done = sum(threads.map(generate, jobs))
+                self.stdout.write(f"{model.__name__}: {done} of {len(jobs)} images")
+
+        self.stdout.write(self.style.SUCCESS("Image variants generated"))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from market import counters, ratings, reservations, sales, stats
+from market.models import CommentProduct, ImageProduct, Product
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the denormalized counters and aggregates from the source tables"
+
+    targets = ('ratings', 'main_images', 'view_counts', 'comment_counts', 'sales', 'shop_stats', 'reservations')
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='*',
+                            help=f"Aggregates to rebuild: {', '.join(self.targets)} (default: all)")
+
+    def handle(self, *args, **options):
+        unknown = set(options['targets']) - set(self.targets)
+        if unknown:
+            raise CommandError(f"Unknown targets: {', '.join(sorted(unknown))}")
+        for target in options['targets'] or self.targets:
+            getattr(self, f'rebuild_{target}')()
+
+    def rebuild_ratings(self):
+        products, shops = ratings.rebuild_ratings()
+        self.stdout.write(self.style.SUCCESS(f"Ratings rebuilt for {products} products and {shops} shops"))
+
+    def rebuild_main_images(self):
+        main_images = dict(
+            ImageProduct.objects.filter(is_main_image=True).order_by('product_id', 'id')
+            .values_list('product_id', 'id')
+        )
+        with transaction.atomic():
+            Product.objects.exclude(main_image=None).update(main_image=None)
+            Product.objects.bulk_update(
+                [Product(pk=product_id, main_image_id=image_id) for product_id, image_id in main_images.items()],
+                ['main_image'], batch_size=1000,
+            )
+        self.stdout.write(self.style.SUCCESS(f"Main image set on {len(main_images)} products"))
+
+    def rebuild_view_counts(self):
+        rebuilt = counters.rebuild_view_counts()
+        for kind, total in rebuilt.items():
+            self.stdout.write(self.style.SUCCESS(f"{kind.label} rebuilt for {total} rows"))
+
+    def rebuild_comment_counts(self):
+        counts = (CommentProduct.objects.order_by().values('product_id')
+                  .annotate(total=Count('id')).values_list('product_id', 'total'))
+        with transaction.atomic():
+            Product.objects.exclude(comments_count=0).update(comments_count=0)
+            products = [Product(pk=product_id, comments_count=total) for product_id, total in counts]
+            Product.objects.bulk_update(products, ['comments_count'], batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(f"Comment counts rebuilt for {len(products)} products"))
+
+    def rebuild_sales(self):
+        total = sales.rebuild_sales()
+        self.stdout.write(self.style.SUCCESS(f"Units sold and revenue rebuilt for {total} products"))
+
+    def rebuild_shop_stats(self):
+        total = stats.rebuild_shop_stats()
+        self.stdout.write(self.style.SUCCESS(f"Shop stats rebuilt for {total} shops"))
+
+    def rebuild_reservations(self):
+        total = reservations.rebuild_reserved_quantities()
+        self.stdout.write(self.style.SUCCESS(f"Reserved quantities rebuilt for {total} products"))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from market import search
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the product full-text search index from the Product table"
+
+    def handle(self, *args, **options):
+        search.create_index()
+        total = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} products"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from market import caching, sales
+
+
+class Command(BaseCommand):
+    help = "Recomputes the time-decayed sales popularity of every product (run it periodically, e.g. hourly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--half-life', type=float, default=sales.HALF_LIFE_DAYS,
+                            help='Days after which a sale counts half')
+        parser.add_argument('--window', type=int, default=sales.WINDOW_DAYS,
+                            help='Ignore sales older than this many days')
+
+    def handle(self, *args, **options):
+        total = sales.refresh_popularity(options['half_life'], options['window'])
+        caching.invalidate('product_list')
+        self.stdout.write(self.style.SUCCESS(f"Popularity refreshed for {total} products"))
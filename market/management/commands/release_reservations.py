@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from market import reservations
+
+
+class Command(BaseCommand):
+    help = "Gives back the stock held by cart reservations that lapsed (run it periodically, e.g. every minute)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=reservations.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        total = reservations.release_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Released {total} reservations"))
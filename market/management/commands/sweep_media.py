@@ -0,0 +1,30 @@
+import datetime
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from market import storage, uploads
+
+
+class Command(BaseCommand):
+    help = "Deletes uploaded files no image field references any more (run it periodically, e.g. hourly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=float, default=storage.SWEEP_GRACE.total_seconds() / 3600,
+                            help='Hours a file must have been unreferenced before it is deleted')
+        parser.add_argument('--no-recount', action='store_true',
+                            help='Trust the live reference counts instead of recounting them first')
+        parser.add_argument('--dry-run', action='store_true', help='Only recount and report')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, storage.ContentAddressedStorage):
+            raise CommandError('The default storage is not ContentAddressedStorage.')
+        if not options['no_recount']:
+            changed = storage.recount()
+            self.stdout.write(f"Corrected {changed} reference counts")
+        if options['dry_run']:
+            return
+        expired = uploads.expire_sessions()
+        self.stdout.write(f"Removed {expired} abandoned uploads")
+        files, freed = storage.sweep(grace=datetime.timedelta(hours=options['grace']))
+        self.stdout.write(self.style.SUCCESS(f"Deleted {files} files, {freed / 1024 / 1024:.1f} MB freed"))
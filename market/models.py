@@ -1,6 +1,9 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.db.models import Q
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -14,6 +17,7 @@ User = get_user_model()
 class Category(models.Model):
     title = models.CharField(max_length=100)
     avatar = models.ImageField(upload_to='category_avatars/')
+    avatar_variants = models.JSONField(default=dict, blank=True)
     is_deleted = models.BooleanField(default=False)
 
     def delete(self):
@@ -27,8 +31,12 @@ class Shop(models.Model):
     title = models.CharField(max_length=100, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     avatar = models.ImageField(upload_to='shop_avatars/')
+    avatar_variants = models.JSONField(default=dict, blank=True)
     review_count = models.IntegerField(default=0)
     is_deleted = models.BooleanField(default=False)
+    crown_sum = models.IntegerField(default=0)
+    crown_count = models.IntegerField(default=0)
+    avg_crowns = models.DecimalField(max_digits=3, decimal_places=2, default=0)
 
     def delete(self):
         self.is_deleted = True
@@ -36,6 +44,15 @@ class Shop(models.Model):
 
 
 
+class ShopStats(models.Model):
+    shop = models.OneToOneField(Shop, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    total_products = models.IntegerField(default=0)
+    total_orders = models.IntegerField(default=0)
+    last_product = models.ForeignKey('Product', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    top_product_ids = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class Product(models.Model):
     title = models.CharField(max_length=100)
     description = models.TextField(null=True)
@@ -43,25 +60,76 @@ class Product(models.Model):
     quantity = models.IntegerField(default=1)
     discount = models.IntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='products')
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='category_products')
     is_deleted = models.BooleanField(default=False)
     views_count = models.IntegerField(default=0)
+    comments_count = models.IntegerField(default=0)
+    units_sold = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    popularity = models.FloatField(default=0)
+    crown_sum = models.IntegerField(default=0)
+    crown_count = models.IntegerField(default=0)
+    avg_crowns = models.DecimalField(max_digits=3, decimal_places=2, default=0)
+    # Units held by carts, see market/reservations.py.
+    reserved_quantity = models.IntegerField(default=0)
+    main_image = models.ForeignKey('ImageProduct', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    # Kept up to date by the modules that own them, never by a full save().
+    DENORMALIZED_FIELDS = (
+        'views_count', 'comments_count', 'units_sold', 'revenue', 'popularity',
+        'crown_sum', 'crown_count', 'avg_crowns', 'reserved_quantity', 'main_image',
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='product_newest_idx', condition=Q(is_deleted=False)),
+            models.Index(fields=['price', 'id'], name='product_price_idx', condition=Q(is_deleted=False)),
+            models.Index(fields=['-avg_crowns', '-id'], name='product_rating_idx', condition=Q(is_deleted=False)),
+            models.Index(fields=['-views_count', '-id'], name='product_viewed_idx', condition=Q(is_deleted=False)),
+            models.Index(fields=['-popularity', '-id'], name='product_popular_idx', condition=Q(is_deleted=False)),
+            models.Index(fields=['shop', '-popularity', '-id'], name='product_shop_popular_idx',
+                         condition=Q(is_deleted=False)),
+            models.Index(fields=['category', '-popularity', '-id'], name='product_category_popular_idx',
+                         condition=Q(is_deleted=False)),
+            models.Index(fields=['shop', '-units_sold', '-id'], name='product_shop_sold_idx',
+                         condition=Q(is_deleted=False)),
+        ]
+
+    @property
+    def available(self):
+        return max(self.quantity - self.reserved_quantity, 0)
+
+    def save(self, *args, **kwargs):
+        # The denormalized columns change under concurrent F() and queryset
+        # updates; writing back the copies loaded with the row would lose some.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.DENORMALIZED_FIELDS]
+        super().save(*args, **kwargs)
 
     def delete(self):
         self.is_deleted = True
-        self.save()
+        self.save(update_fields=['is_deleted', 'updated_at'])
 
 
 
 class ImageProduct(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='product_additional_images/')
+    # Resized copies written by market/images.py, see variant_urls().
+    variants = models.JSONField(default=dict, blank=True)
     is_main_image = models.BooleanField(default=False)
     def save(self, *args, **kwargs):
+        adding = self._state.adding
         if self.is_main_image and self.product_id:
             ImageProduct.objects.filter(product_id=self.product_id).update(is_main_image=False)
         super().save(*args, **kwargs)
+        if self.is_main_image:
+            Product.objects.filter(pk=self.product_id).update(main_image=self)
+        elif not adding:
+            Product.objects.filter(pk=self.product_id, main_image=self).update(main_image=None)
 
 
 class CommentProduct(models.Model):
@@ -70,6 +138,11 @@ class CommentProduct(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comments')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', '-created_at', '-id'], name='comment_product_newest_idx'),
+        ]
+
 
 class CrownProduct(models.Model):
     class CrownChoices(models.IntegerChoices):
@@ -125,6 +198,11 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='order_created_idx'),
+        ]
+
     def __str__(self):
         return f'Order #{self.id} - {self.user.first_name} {self.user.last_name} - {self.product.title}'
 
@@ -134,6 +212,11 @@ class OrderItem(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     price_at_purchase = models.DecimalField(max_digits=20, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='order_item_created_idx'),
+        ]
     
     def __str__(self):
         return f'{self.product.title} x {self.quantity} @{self.price_at_purchase}'
@@ -148,21 +231,109 @@ class ReviewProduct(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reviews')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='product_reviews')
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'user'], name='review_product_unique'),
+        ]
+
 
 class ReviewShop(models.Model):
     shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='reviews')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='shop_reviews')
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'user'], name='review_shop_unique'),
+        ]
 
 
+class ProductCooccurrence(models.Model):
+    # Number of orders containing both products, stored in both directions;
+    # product_a == product_b holds the number of orders containing it.
+    product_a = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    product_b = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    count = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product_a', 'product_b'], name='product_cooccurrence_unique'),
+        ]
 
-# from pgvector.django import VectorField
-#
-# class ProductImageEmbedding(models.Model):
-#     product_image = models.OneToOneField(ImageProduct, on_delete=models.CASCADE, related_name='embedding')
-#     embedding = VectorField(dimensions=512)
-#     created_at = models.DateTimeField(auto_now_add=True)
-#
-#     def __str__(self):
-#         return f"Embedding for {self.product_image.id}"
+
+class ProductNeighbor(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='neighbors')
+    neighbor = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='product_neighbor_rank_unique'),
+        ]
+
+
+class StockReservation(models.Model):
+    # Units of a product held for a cart line until expires_at; counted in
+    # Product.reserved_quantity until released or ordered.
+    cart = models.OneToOneField(Cart, on_delete=models.CASCADE, related_name='reservation')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    quantity = models.IntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class JobWatermark(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ImageDescriptor(models.Model):
+    # Compact visual features of a product image for similarity search, see
+    # market/visual.py: float16 color and edge histograms plus a 64-bit dHash.
+    image = models.OneToOneField(ImageProduct, on_delete=models.CASCADE, related_name='descriptor')
+    vector = models.BinaryField()
+    dhash = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class MediaBlob(models.Model):
+    # A file of market.storage.ContentAddressedStorage and how many image
+    # fields point to it; updated_at moves whenever the count does.
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['refcount', 'updated_at'], name='media_blob_sweep_idx'),
+        ]
+
+
+class UploadSession(models.Model):
+    # A resumable image upload, written to UPLOAD_SESSION_DIR/<id>.part
+    # chunk by chunk until it is complete, see market/uploads.py.
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class CounterRecount(models.Model):
+    # A counter column whose viewers changed since it was last recounted,
+    # see market/counters.py.
+    class Kind(models.TextChoices):
+        PRODUCT_VIEWS = 'PV', 'Product views'
+        SHOP_REVIEWS = 'SR', 'Shop reviews'
+    kind = models.CharField(max_length=2, choices=Kind.choices)
+    object_id = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='counter_recount_unique'),
+        ]
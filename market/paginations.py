@@ -1,6 +1,183 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import datetime
+import decimal
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
 
 class CustomPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
-    max_page_size = 10
\ No newline at end of file
+    max_page_size = 10
+
+
+class KeysetPagination(BasePagination):
+    # Every sort mode maps to (field, descending). The primary key is always used
+    # as the tie breaker, so the cursor is a (value, id) pair and the next page is
+    # a plain range read on the matching index instead of an OFFSET scan.
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    sort_query_param = 'sort'
+    sort_modes = {}
+    default_sort = None
+
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_sort(self, request, queryset):
+        sort = request.query_params.get(self.sort_query_param, self.default_sort)
+        return sort if sort in self.sort_modes else self.default_sort
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def get_sort_field(self, queryset):
+        try:
+            return queryset.model._meta.get_field(self.field)
+        except FieldDoesNotExist:
+            return queryset.query.annotations[self.field].output_field
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            sort, value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            # A cursor of another sort mode holds a value of another field.
+            if sort != self.sort or value is None:
+                raise ValueError(sort)
+            return self.get_sort_field(queryset).to_python(value), int(pk)
+        except (TypeError, ValueError, UnicodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def _cursor_value(value):
+        # Keep full precision: a truncated timestamp would skip or repeat rows.
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        raise TypeError(f'Unsupported cursor value {value!r}')
+
+    def encode_cursor(self, value, pk):
+        raw = json.dumps([self.sort, value, pk], default=self._cursor_value, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.sort = self.get_sort(request, queryset)
+        self.field, self.descending = self.sort_modes[self.sort]
+        prefix = '-' if self.descending else ''
+        queryset = queryset.order_by(f'{prefix}{self.field}', f'{prefix}pk')
+
+        cursor = self.decode_cursor(request, queryset)
+        if cursor is not None:
+            value, pk = cursor
+            op = 'lt' if self.descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__{op}': value}) |
+                Q(**{self.field: value, f'pk__{op}': pk})
+            )
+
+        size = self.get_page_size(request)
+        page = list(queryset[:size + 1])
+        self.has_next = len(page) > size
+        self.page = page[:size]
+        return self.page
+
+    def get_next_cursor(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        return self.encode_cursor(getattr(last, self.field), last.pk)
+
+    def get_links(self, request, next_cursor):
+        url = request.build_absolute_uri()
+        next_link = replace_query_param(url, self.cursor_query_param, next_cursor) if next_cursor else None
+        return next_link, remove_query_param(url, self.cursor_query_param)
+
+    def get_next_link(self):
+        return self.get_links(self.request, self.get_next_cursor())[0]
+
+    def get_first_link(self):
+        return self.get_links(self.request, None)[1]
+
+    def get_page_data(self, data):
+        # The cacheable part of a page: no links, they depend on the URL asked for.
+        return {'sort': self.sort, 'next_cursor': self.get_next_cursor(), 'results': data}
+
+    def add_links(self, request, page_data):
+        """``get_page_data`` output with its cursor turned into links for ``request``.
+
+        A cached page is served to requests whose URLs differ in parameter
+        order, spelling or unknown parameters, so the links are built for
+        each of them instead of being cached with the page.
+        """
+        page_data = dict(page_data)
+        next_link, first_link = self.get_links(request, page_data.pop('next_cursor'))
+        return {'sort': page_data.pop('sort'), 'next': next_link, 'first': first_link, **page_data}
+
+    def get_paginated_response(self, data):
+        return Response({
+            'sort': self.sort,
+            'next': self.get_next_link(),
+            'first': self.get_first_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'sort': {'type': 'string'},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'first': {'type': 'string', 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ProductCursorPagination(KeysetPagination):
+    sort_modes = {
+        'newest': ('created_at', True),
+        'price_asc': ('price', False),
+        'price_desc': ('price', True),
+        'rating': ('avg_crowns', True),
+        'popular': ('popularity', True),
+        'most_viewed': ('views_count', True),
+        'relevance': ('search_rank', False),
+    }
+    default_sort = 'newest'
+
+    def get_sort(self, request, queryset):
+        # Relevance only exists on full-text search results, where it is also
+        # the natural default.
+        searching = 'search_rank' in queryset.query.annotations
+        sort = request.query_params.get(self.sort_query_param)
+        if sort == 'relevance' and not searching:
+            sort = None
+        if sort not in self.sort_modes:
+            sort = 'relevance' if searching else self.default_sort
+        return sort
+
+
+class CommentCursorPagination(KeysetPagination):
+    sort_modes = {
+        'newest': ('created_at', True),
+        'oldest': ('created_at', False),
+    }
+    default_sort = 'newest'
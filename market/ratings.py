@@ -0,0 +1,62 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, FloatField, Sum
+from django.db.models.functions import Cast, Round
+
+from .models import CrownProduct, Product, Shop
+
+
+def _average(crown_sum, crown_count):
+    if not crown_count:
+        return Decimal('0.00')
+    return (Decimal(crown_sum) / Decimal(crown_count)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def _rating_delta(sum_delta, count_delta):
+    # One UPDATE per row: the average is derived from the same incremented
+    # values, so concurrent ratings never leave sum, count and avg out of step.
+    average = Cast(
+        Cast(F('crown_sum') + sum_delta, FloatField()) / (F('crown_count') + count_delta),
+        DecimalField(max_digits=6, decimal_places=4),
+    )
+    return {
+        'crown_sum': F('crown_sum') + sum_delta,
+        'crown_count': F('crown_count') + count_delta,
+        'avg_crowns': Round(average, 2),
+    }
+
+
+def apply_crown_change(product, old_crowns, new_crowns):
+    sum_delta = new_crowns - (old_crowns or 0)
+    count_delta = 0 if old_crowns is not None else 1
+    if not sum_delta and not count_delta:
+        return
+    changes = _rating_delta(sum_delta, count_delta)
+    Product.objects.filter(pk=product.pk).update(**changes)
+    Shop.objects.filter(pk=product.shop_id).update(**changes)
+
+
+def rebuild_ratings(batch_size=1000):
+    fields = ['crown_sum', 'crown_count', 'avg_crowns']
+    with transaction.atomic():
+        Product.objects.update(crown_sum=0, crown_count=0, avg_crowns=0)
+        rows = (CrownProduct.objects.order_by().values('product_id')
+                .annotate(total=Sum('crowns'), count=Count('id')))
+        products = [
+            Product(pk=row['product_id'], crown_sum=row['total'], crown_count=row['count'],
+                    avg_crowns=_average(row['total'], row['count']))
+            for row in rows
+        ]
+        Product.objects.bulk_update(products, fields, batch_size=batch_size)
+
+        Shop.objects.update(crown_sum=0, crown_count=0, avg_crowns=0)
+        rows = (Product.objects.order_by().filter(crown_count__gt=0).values('shop_id')
+                .annotate(total=Sum('crown_sum'), count=Sum('crown_count')))
+        shops = [
+            Shop(pk=row['shop_id'], crown_sum=row['total'], crown_count=row['count'],
+                 avg_crowns=_average(row['total'], row['count']))
+            for row in rows
+        ]
+        Shop.objects.bulk_update(shops, fields, batch_size=batch_size)
+    return len(products), len(shops)
@@ -0,0 +1,180 @@
+import datetime
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .caching import invalidate
+from .models import JobWatermark, Order, OrderItem, ProductCooccurrence, ProductNeighbor
+
+
+WATERMARK = 'recommendations'
+TOP_K = 10
+MIN_COUNT = 2
+# A basket of n products adds n * n pairs; very large orders say little about
+# what goes together and would dominate the work.
+MAX_BASKET = 50
+ORDERS_PER_BATCH = 50000
+# Orders younger than this may still be committing their items.
+SETTLE_DELAY = datetime.timedelta(minutes=5)
+QUERY_CHUNK = 500
+
+
+def _chunks(values, size=QUERY_CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def basket_pairs(order_ids, product_ids, max_basket=MAX_BASKET):
+    """Counts how many orders contain each pair of products.
+
+    ``order_ids`` and ``product_ids`` are parallel arrays of order items.
+    The result is the non-zero part of ``X.T @ X`` for the binary
+    order x product matrix ``X``, both directions plus the diagonal, as
+    three arrays ``(a, b, count)``. Every basket is expanded into its pairs
+    with array arithmetic instead of a Python loop over orders.
+    """
+    order_ids = np.asarray(order_ids, dtype=np.int64)
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+    empty = np.empty(0, dtype=np.int64)
+    if not len(order_ids):
+        return empty, empty, empty
+    stride = int(product_ids.max()) + 1
+
+    # Sorted by order then product, one entry per (order, product).
+    items = np.unique(order_ids * stride + product_ids)
+    orders, products = items // stride, items % stride
+    starts = np.flatnonzero(np.r_[True, orders[1:] != orders[:-1]])
+    sizes = np.diff(np.r_[starts, len(items)])
+    keep = sizes <= max_basket
+    products = products[np.repeat(keep, sizes)]
+    sizes = sizes[keep]
+    if not len(sizes):
+        return empty, empty, empty
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+
+    # Item i of a basket of size n is paired with each of the n items of its
+    # basket, itself included.
+    per_item = np.repeat(sizes, sizes)
+    left = np.repeat(products, per_item)
+    offsets = np.r_[0, np.cumsum(per_item)[:-1]]
+    position = np.arange(per_item.sum()) - np.repeat(offsets, per_item)
+    right = products[np.repeat(np.repeat(starts, sizes), per_item) + position]
+
+    pairs, counts = np.unique(left * stride + right, return_counts=True)
+    return pairs // stride, pairs % stride, counts
+
+
+def top_neighbors(a, b, counts, diagonal, k=TOP_K, min_count=MIN_COUNT):
+    """Cosine similarity ``C[a, b] / sqrt(C[a, a] * C[b, b])``, top ``k`` per ``a``.
+
+    Returns ``(a, b, rank, score)`` arrays; ``diagonal`` maps a product to
+    the number of orders containing it.
+    """
+    mask = (a != b) & (counts >= min_count)
+    a, b, counts = a[mask], b[mask], counts[mask].astype(np.float64)
+    lookup = np.vectorize(lambda pk: diagonal.get(pk, 0), otypes=[np.float64])
+    norms = np.sqrt(lookup(a) * lookup(b)) if len(a) else np.empty(0)
+    scores = np.divide(counts, norms, out=np.zeros_like(counts), where=norms > 0)
+
+    order = np.lexsort((b, -scores, a))
+    a, b, scores = a[order], b[order], scores[order]
+    starts = np.flatnonzero(np.r_[True, a[1:] != a[:-1]]) if len(a) else np.empty(0, dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(a)])
+    rank = np.arange(len(a)) - np.repeat(starts, sizes)
+    top = rank < k
+    return a[top], b[top], rank[top], scores[top]
+
+
+class RecommendationBuilder:
+    """Incrementally maintains "frequently bought together" neighbours.
+
+    Each run reads only the orders after the stored watermark, adds their
+    pair counts to ``ProductCooccurrence`` and recomputes the top-K
+    neighbours of the products those orders contained. A neighbour's score
+    also depends on how often it sells overall, so products that were not
+    touched keep slightly stale scores until they are; ``full=True``
+    recomputes everything from scratch.
+    """
+
+    def __init__(self, k=TOP_K, min_count=MIN_COUNT, max_basket=MAX_BASKET, batch_size=ORDERS_PER_BATCH):
+        self.k = k
+        self.min_count = min_count
+        self.max_basket = max_basket
+        self.batch_size = batch_size
+
+    def run(self, full=False):
+        if full:
+            with transaction.atomic():
+                ProductCooccurrence.objects.all().delete()
+                ProductNeighbor.objects.all().delete()
+                JobWatermark.objects.update_or_create(name=WATERMARK, defaults={'last_id': 0})
+        watermark, _ = JobWatermark.objects.get_or_create(name=WATERMARK)
+        settled = Order.objects.filter(created_at__lt=timezone.now() - SETTLE_DELAY)
+        orders, products = 0, set()
+        while True:
+            last_id = (settled.filter(id__gt=watermark.last_id).order_by('id')
+                       .values_list('id', flat=True)[self.batch_size - 1:self.batch_size].first())
+            if last_id is None:
+                last_id = settled.filter(id__gt=watermark.last_id).order_by('-id').values_list('id', flat=True).first()
+            if last_id is None:
+                return orders, len(products)
+            batch_orders, batch_products = self._process(watermark, last_id)
+            orders += batch_orders
+            products.update(batch_products)
+
+    def _process(self, watermark, last_id):
+        items = list(OrderItem.objects.filter(order_id__gt=watermark.last_id, order_id__lte=last_id)
+                     .exclude(order__status=Order.Status.CANCELLED).values_list('order_id', 'product_id'))
+        a, b, counts = basket_pairs(*zip(*items), max_basket=self.max_basket) if items else ([], [], [])
+        touched = sorted(set(np.asarray(a).tolist()))
+
+        with transaction.atomic():
+            cooccurrence = self._merge(a, b, counts, touched)
+            self._store_neighbors(touched, cooccurrence)
+            orders = Order.objects.filter(id__gt=watermark.last_id, id__lte=last_id).count()
+            watermark.last_id = last_id
+            watermark.save()
+        invalidate(*[f'product:{pk}' for pk in touched])
+        return orders, touched
+
+    def _merge(self, a, b, counts, touched):
+        existing = {}
+        for chunk in _chunks(touched):
+            existing.update({(pa, pb): count for pa, pb, count in ProductCooccurrence.objects.filter(
+                product_a_id__in=chunk).values_list('product_a_id', 'product_b_id', 'count')})
+
+        rows = []
+        for pa, pb, count in zip(np.asarray(a).tolist(), np.asarray(b).tolist(), np.asarray(counts).tolist()):
+            existing[(pa, pb)] = existing.get((pa, pb), 0) + count
+            rows.append(ProductCooccurrence(product_a_id=pa, product_b_id=pb, count=existing[(pa, pb)]))
+        # The totals are computed here, so new and existing pairs go through
+        # one upsert instead of a create plus a CASE update.
+        ProductCooccurrence.objects.bulk_create(
+            rows, batch_size=1000, update_conflicts=True,
+            unique_fields=['product_a', 'product_b'], update_fields=['count'],
+        )
+        return existing
+
+    def _store_neighbors(self, touched, cooccurrence):
+        if not touched:
+            return
+        a = np.fromiter((pa for pa, _ in cooccurrence), dtype=np.int64, count=len(cooccurrence))
+        b = np.fromiter((pb for _, pb in cooccurrence), dtype=np.int64, count=len(cooccurrence))
+        counts = np.fromiter(cooccurrence.values(), dtype=np.int64, count=len(cooccurrence))
+
+        diagonal = {pa: count for (pa, pb), count in cooccurrence.items() if pa == pb}
+        missing = set(b.tolist()) - set(diagonal)
+        for chunk in _chunks(missing):
+            diagonal.update(ProductCooccurrence.objects.filter(product_a_id__in=chunk, product_b_id=F('product_a_id'))
+                            .values_list('product_a_id', 'count'))
+
+        a, b, rank, scores = top_neighbors(a, b, counts, diagonal, self.k, self.min_count)
+        for chunk in _chunks(touched):
+            ProductNeighbor.objects.filter(product_id__in=chunk).delete()
+        ProductNeighbor.objects.bulk_create([
+            ProductNeighbor(product_id=pa, neighbor_id=pb, rank=r, score=round(s, 6))
+            for pa, pb, r, s in zip(a.tolist(), b.tolist(), rank.tolist(), scores.tolist())
+        ], batch_size=1000)
@@ -0,0 +1,128 @@
+import datetime
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.utils import timezone
+
+from .caching import invalidate_on_commit
+from .models import Product, StockReservation
+
+
+BATCH_SIZE = 1000
+
+
+def reservation_ttl():
+    return datetime.timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_MINUTES', 15))
+
+
+def held(cart_item):
+    """Units the cart line holds; select_related('reservation') to avoid a query."""
+    try:
+        return cart_item.reservation.quantity
+    except ObjectDoesNotExist:
+        return 0
+
+
+def _reserve(product_id, delta):
+    return Product.objects.filter(pk=product_id, is_deleted=False, quantity__gte=F('reserved_quantity') + delta).update(
+        reserved_quantity=F('reserved_quantity') + delta)
+
+
+def hold(cart_item, quantity):
+    """Holds ``quantity`` units for a cart line until the reservation TTL passes.
+
+    Only the difference to what the line already holds is taken from the
+    product, with a conditional update, so buyers racing for the last units
+    can't hold more than there is. Renewing a hold moves its expiry. Returns
+    False, holding nothing new, if the units are not available.
+    """
+    product_id = cart_item.product_id
+    expires_at = timezone.now() + reservation_ttl()
+    with transaction.atomic():
+        reservation = StockReservation.objects.select_for_update().filter(cart=cart_item).first()
+        if reservation:
+            # Renewed first, so the sweep below can't release it.
+            StockReservation.objects.filter(pk=reservation.pk).update(expires_at=expires_at)
+        delta = quantity - (reservation.quantity if reservation else 0)
+        if delta > 0 and not _reserve(product_id, delta):
+            # Lapsed holds may still be counted if the sweeper hasn't run yet.
+            if not release_expired(product_ids=[product_id]) or not _reserve(product_id, delta):
+                return False
+        elif delta < 0:
+            Product.objects.filter(pk=product_id).update(reserved_quantity=F('reserved_quantity') + delta)
+
+        if reservation:
+            StockReservation.objects.filter(pk=reservation.pk).update(quantity=quantity)
+        else:
+            StockReservation.objects.create(cart=cart_item, product_id=product_id, quantity=quantity,
+                                            expires_at=expires_at)
+        if delta:
+            invalidate_on_commit(f'product:{product_id}')
+    return True
+
+
+def release(cart_items):
+    """Gives back the units held by cart lines that are removed without an order."""
+    with transaction.atomic():
+        reservations = list(StockReservation.objects.select_for_update()
+                            .filter(cart__in=cart_items).values_list('id', 'product_id', 'quantity'))
+        _release(reservations)
+
+
+def take(cart_items):
+    """Locks the holds of cart lines being ordered; returns ``{product_id: units}``.
+
+    The units stay counted in ``reserved_quantity`` until ``sales.sell``
+    moves them out of stock; deleting the cart lines deletes the holds.
+    """
+    reservations = (StockReservation.objects.select_for_update().filter(cart__in=cart_items)
+                    .values_list('product_id', 'quantity'))
+    return dict(reservations)
+
+
+def _release(reservations):
+    if not reservations:
+        return
+    StockReservation.objects.filter(pk__in=[pk for pk, _, _ in reservations]).delete()
+    totals = Counter()
+    for _, product_id, quantity in reservations:
+        totals[product_id] += quantity
+    Product.objects.filter(pk__in=list(totals)).update(reserved_quantity=F('reserved_quantity') - Case(
+        *[When(pk=product_id, then=Value(total)) for product_id, total in totals.items()],
+        default=Value(0), output_field=IntegerField(),
+    ))
+    invalidate_on_commit(*[f'product:{product_id}' for product_id in totals])
+
+
+def release_expired(product_ids=None, batch_size=BATCH_SIZE):
+    """Releases lapsed holds in batches; returns how many were released.
+
+    Holds being renewed or checked out are locked and skipped.
+    """
+    now = timezone.now()
+    expired = StockReservation.objects.filter(expires_at__lte=now)
+    if product_ids is not None:
+        expired = expired.filter(product_id__in=product_ids)
+    released = 0
+    while True:
+        with transaction.atomic():
+            batch = list(expired.select_for_update(skip_locked=True).order_by('expires_at')
+                         .values_list('id', 'product_id', 'quantity')[:batch_size])
+            _release(batch)
+        released += len(batch)
+        if len(batch) < batch_size:
+            return released
+
+
+def rebuild_reserved_quantities(batch_size=BATCH_SIZE):
+    """Resets ``Product.reserved_quantity`` from the holds, after a crash or a deleted user."""
+    totals = (StockReservation.objects.order_by().values('product_id')
+              .annotate(total=Sum('quantity')).values_list('product_id', 'total'))
+    with transaction.atomic():
+        Product.objects.exclude(reserved_quantity=0).update(reserved_quantity=0)
+        products = [Product(pk=product_id, reserved_quantity=total) for product_id, total in totals]
+        Product.objects.bulk_update(products, ['reserved_quantity'], batch_size=batch_size)
+    return len(products)
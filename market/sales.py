@@ -0,0 +1,92 @@
+import datetime
+import math
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import OrderItem, Product
+
+
+HALF_LIFE_DAYS = 7
+WINDOW_DAYS = 90
+
+LINE_TOTAL = ExpressionWrapper(F('quantity') * F('price_at_purchase'),
+                               output_field=DecimalField(max_digits=20, decimal_places=2))
+
+
+def sell(lines, held=None):
+    """Takes sold units out of stock and adds them to the sales counters.
+
+    ``lines`` maps product ids to ``(units, total)`` and ``held`` to the
+    units the order's cart lines hold (market/reservations.py), which are
+    moved out of ``reserved_quantity``. A single UPDATE covers every product
+    and only matches rows that still have the units available, so
+    concurrent checkouts can neither oversell nor wait on each other's row
+    locks in different orders. If any product is short nothing is changed
+    and its id is returned; run it inside the order's transaction.
+    """
+    held = held or {}
+    ids = sorted(lines)
+    in_stock = Q()
+    units, totals, holds = [], [], []
+    for pk in ids:
+        count, total = lines[pk]
+        in_stock |= Q(pk=pk, quantity__gte=F('reserved_quantity') - held.get(pk, 0) + count)
+        units.append(When(pk=pk, then=Value(count)))
+        totals.append(When(pk=pk, then=Value(total)))
+        holds.append(When(pk=pk, then=Value(held.get(pk, 0))))
+    units = Case(*units, output_field=IntegerField())
+    totals = Case(*totals, output_field=DecimalField(max_digits=14, decimal_places=2))
+
+    savepoint = transaction.savepoint()
+    updated = Product.objects.filter(in_stock, is_deleted=False).update(
+        quantity=F('quantity') - units, units_sold=F('units_sold') + units, revenue=F('revenue') + totals,
+        reserved_quantity=F('reserved_quantity') - Case(*holds, output_field=IntegerField()),
+        updated_at=timezone.now(),
+    )
+    if updated == len(ids):
+        transaction.savepoint_commit(savepoint)
+        return []
+    transaction.savepoint_rollback(savepoint)
+    available = dict(Product.objects.filter(pk__in=ids, is_deleted=False)
+                     .values_list('pk', F('quantity') - F('reserved_quantity')))
+    return [pk for pk in ids if available.get(pk, 0) + held.get(pk, 0) < lines[pk][0]]
+
+
+def rebuild_sales(batch_size=1000):
+    rows = (OrderItem.objects.order_by().values('product_id')
+            .annotate(units=Sum('quantity'), total=Sum(LINE_TOTAL)))
+    with transaction.atomic():
+        Product.objects.exclude(units_sold=0, revenue=0).update(units_sold=0, revenue=0)
+        products = [Product(pk=row['product_id'], units_sold=row['units'], revenue=row['total']) for row in rows]
+        Product.objects.bulk_update(products, ['units_sold', 'revenue'], batch_size=batch_size)
+    return len(products)
+
+
+def refresh_popularity(half_life_days=HALF_LIFE_DAYS, window_days=WINDOW_DAYS, batch_size=1000):
+    """Recomputes ``Product.popularity`` as exponentially decayed units sold.
+
+    A unit sold today counts 1, one sold ``half_life_days`` ago counts 0.5,
+    and sales older than ``window_days`` are ignored. Sales are summed per
+    product and day in the database, so the work done here grows with the
+    number of (product, day) pairs rather than with the number of items.
+    """
+    today = timezone.now().date()
+    since = timezone.now() - datetime.timedelta(days=window_days)
+    rows = (OrderItem.objects.filter(created_at__gte=since).order_by()
+            .annotate(day=TruncDate('created_at')).values('product_id', 'day')
+            .annotate(units=Sum('quantity')).values_list('product_id', 'day', 'units'))
+    scores = defaultdict(float)
+    for product_id, day, units in rows.iterator(chunk_size=5000):
+        scores[product_id] += units * math.pow(0.5, (today - day).days / half_life_days)
+
+    with transaction.atomic():
+        Product.objects.filter(popularity__gt=0).update(popularity=0)
+        Product.objects.bulk_update(
+            [Product(pk=product_id, popularity=round(score, 6)) for product_id, score in scores.items()],
+            ['popularity'], batch_size=batch_size,
+        )
+    return len(scores)
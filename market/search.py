@@ -0,0 +1,203 @@
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+
+FTS_TABLE = 'market_product_fts'
+
+# rowid is the product id, so a match joins straight onto market_product's
+# primary key. Title hits weigh ten times more than description hits, and the
+# 2/3 character prefix indexes keep typeahead-style "lap*" queries cheap.
+FTS_SCHEMA = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"title, description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+]
+
+# Lower bounds of the price histogram bands; the last band is open ended.
+PRICE_BANDS = (0, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_available = None
+
+
+def is_available():
+    global _available
+    if _available is None:
+        _available = False
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+                )
+                _available = cursor.fetchone() is not None
+    return _available
+
+
+def normalize_query(text):
+    return ' '.join(text.split()).casefold()[:255]
+
+
+def _parse_price(value):
+    try:
+        price = Decimal(value.strip())
+    except (InvalidOperation, AttributeError):
+        return None
+    if not price.is_finite() or price < 0:
+        return None
+    return price.quantize(Decimal('0.01'))
+
+
+def _parse_id(value):
+    try:
+        pk = int(value)
+    except (TypeError, ValueError):
+        return None
+    return pk if pk > 0 else None
+
+
+def parse_product_filters(query_params):
+    """Canonical product list filters: unknown or malformed values are dropped."""
+    filters = {}
+    query = normalize_query(query_params.get('query', ''))
+    if query:
+        filters['query'] = query
+    category = _parse_id(query_params.get('category'))
+    if category:
+        filters['category'] = category
+    for name in ('min_price', 'max_price'):
+        price = _parse_price(query_params.get(name))
+        if price is not None:
+            filters[name] = price
+    return filters
+
+
+def build_match(text):
+    # Every word must match, the last one as a prefix so partially typed
+    # queries still find something. Terms are quoted to neutralise FTS syntax.
+    tokens = _TOKEN_RE.findall(text.lower())
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens[:-1]]
+    terms.append(f'"{tokens[-1]}"*')
+    return ' '.join(terms)
+
+
+def filter_products(queryset, text):
+    """Restrict a Product queryset to full-text matches, annotated with ``search_rank``."""
+    match = build_match(text)
+    if match is None:
+        return queryset.none()
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=[f'{FTS_TABLE}.rowid = market_product.id', f'{FTS_TABLE} MATCH %s'],
+        params=[match],
+    ).annotate(search_rank=RawSQL(f'{FTS_TABLE}.rank', ()))
+
+
+def create_index():
+    global _available
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        if cursor.fetchone() is not None:
+            _available = True
+            return False
+        for statement in FTS_SCHEMA:
+            cursor.execute(statement)
+    _available = True
+    return True
+
+
+def product_facets(queryset):
+    """Category counts, price histogram and discount count in one GROUP BY."""
+    band = Case(
+        *[When(price__gte=low, then=Value(i)) for i, low in reversed(list(enumerate(PRICE_BANDS)))],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+    rows = (
+        queryset.order_by().annotate(price_band=band)
+        .values('category_id', 'category__title', 'price_band')
+        .annotate(total=Count('id'), discounted=Count('id', filter=Q(discount__gt=0)))
+    )
+
+    categories = {}
+    bands = [0] * len(PRICE_BANDS)
+    discounted = 0
+    for row in rows:
+        category = categories.setdefault(
+            row['category_id'], {'id': row['category_id'], 'title': row['category__title'], 'count': 0}
+        )
+        category['count'] += row['total']
+        bands[row['price_band']] += row['total']
+        discounted += row['discounted']
+
+    highs = list(PRICE_BANDS[1:]) + [None]
+    return {
+        'categories': sorted(categories.values(), key=lambda c: (-c['count'], c['id'])),
+        'price_histogram': [
+            {'min': low, 'max': high, 'count': count}
+            for low, high, count in zip(PRICE_BANDS, highs, bands) if count
+        ],
+        'discounted': discounted,
+    }
+
+
+def ensure_index(**kwargs):
+    # post_migrate hook: the table lives outside the migrations, so create it
+    # (and backfill it) the first time the schema is migrated.
+    if create_index():
+        rebuild_index()
+
+
+def rebuild_index(batch_size=2000):
+    from .models import Product
+
+    if not is_available():
+        return 0
+    total = 0
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            rows = Product.objects.filter(is_deleted=False).values_list('id', 'title', 'description')
+            batch = []
+            for row in rows.iterator(chunk_size=batch_size):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    _insert(cursor, batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                _insert(cursor, batch)
+                total += len(batch)
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+    return total
+
+
+def _insert(cursor, rows):
+    cursor.executemany(
+        f'INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (%s, %s, %s)',
+        [(pk, title, description or '') for pk, title, description in rows],
+    )
+
+
+def index_products(products):
+    if not is_available():
+        return
+    live = [p for p in products if not p.is_deleted]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(p.pk,) for p in products])
+        if live:
+            _insert(cursor, [(p.pk, p.title, p.description) for p in live])
+
+
+def remove_products(product_ids):
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in product_ids])
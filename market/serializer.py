@@ -1,18 +1,74 @@
 from rest_framework import serializers
-from django.db.models import F, Count
+from django.db.models import F
 from django.db import transaction
 from accounts.serializers import GetUserInfoSerialzer
 from decimal import  Decimal
 
+from .images import variant_urls
+from .uploads import MAX_SESSION_SIZE
+from .ratings import apply_crown_change
+from . import reservations
+from .caching import invalidate_on_commit, product_tags
+from .sales import sell
+from .stats import record_order
+
 from .models import (
     Category, Product, ImageProduct, CommentProduct, CrownProduct,
-    ReviewProduct, Shop, User, HistorySearch, Cart, Order, ReviewShop, OrderItem
+    Shop, User, HistorySearch, Cart, Order, OrderItem, UploadSession
 )
 
+class SparseFieldsMixin:
+    """Serializer whose output can be narrowed to a subset of its fields.
+
+    ``expandable_fields`` are the expensive ones: once a client picks fields
+    they are left out unless named in ``fields`` or ``expand``.
+    """
+    expandable_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def select_fields(cls, query_params):
+        if 'fields' not in query_params and 'expand' not in query_params:
+            return None
+
+        def names(param):
+            return {name.strip() for name in query_params.get(param, '').split(',') if name.strip()}
+
+        available = set(cls.Meta.fields)
+        if 'fields' in query_params:
+            selected = names('fields')
+        else:
+            selected = available - set(cls.expandable_fields)
+        selected |= names('expand') & set(cls.expandable_fields)
+        return sorted(selected & available | {'id'})
+
+
+class ImageVariantsField(serializers.Field):
+    """Read-only map of an image field's resized variants, see ``variant_urls``."""
+
+    def __init__(self, image_field, variants_field, **kwargs):
+        self.image_field = image_field
+        self.variants_field = variants_field
+        kwargs.update(source='*', read_only=True)
+        super().__init__(**kwargs)
+
+    def to_representation(self, obj):
+        return variant_urls(getattr(obj, self.image_field), getattr(obj, self.variants_field),
+                            self.context.get('request'))
+
+
 class CategorySerializer(serializers.ModelSerializer):
+    avatar_variants = ImageVariantsField('avatar', 'avatar_variants')
+
     class Meta:
         model = Category
-        fields = ('id', 'title', 'avatar')
+        fields = ('id', 'title', 'avatar', 'avatar_variants')
         read_only_fields = ('id',)
     
     def validate_title(self, value):
@@ -23,10 +79,11 @@ class CategorySerializer(serializers.ModelSerializer):
 class ShopSerializer(serializers.ModelSerializer):
     avg_crowns = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
     avatar = serializers.ImageField(required=False, allow_null=True)
+    avatar_variants = ImageVariantsField('avatar', 'avatar_variants')
 
     class Meta:
         model = Shop
-        fields = ('id', 'title', 'bio', 'avatar', 'avg_crowns',  'review_count')
+        fields = ('id', 'title', 'bio', 'avatar', 'avatar_variants', 'avg_crowns',  'review_count')
         read_only_fields = ('id',  'review_count')
     
     def validate(self, attrs):
@@ -45,79 +102,113 @@ class ShopSerializer(serializers.ModelSerializer):
         return Shop.objects.create(seller=user, **validated_data)
 
 
-class ShopDetailSerializer(serializers.ModelSerializer):
+class ShopDetailSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     seller_full_name = serializers.SerializerMethodField()
     avg_crowns = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
-    total_products = serializers.IntegerField(read_only=True)
-    total_orders = serializers.IntegerField(read_only=True)
+    total_products = serializers.SerializerMethodField()
+    total_orders = serializers.SerializerMethodField()
     avatar = serializers.ImageField(required=False, allow_null=True)
+    avatar_variants = ImageVariantsField('avatar', 'avatar_variants')
     last_added_product = serializers.SerializerMethodField()  
     most_popular_products = serializers.SerializerMethodField()
 
     class Meta:
         model = Shop
-        fields = ('id', 'seller_full_name','title', 'bio', 'avatar', 'avg_crowns', 
+        fields = ('id', 'seller_full_name','title', 'bio', 'avatar', 'avatar_variants', 'avg_crowns', 
                   'total_products', 'total_orders', 'review_count', 'last_added_product', 
                   'most_popular_products', 'created_at')
         read_only_fields = ('id', 'seller_full_name', 'review_count')
+
+    expandable_fields = ('last_added_product', 'most_popular_products')
     
     def get_seller_full_name(self, obj):
         return f'{obj.seller.first_name} {obj.seller.last_name}'.strip()
 
+    def get_total_products(self, obj):
+        stats = getattr(obj, 'stats', None)
+        return stats.total_products if stats else 0
+
+    def get_total_orders(self, obj):
+        stats = getattr(obj, 'stats', None)
+        return stats.total_orders if stats else 0
+
+    def _stats_products(self, obj):
+        # Last and most popular products come from ShopStats and are loaded
+        # together in one query.
+        loaded = getattr(self, '_stats_products_cache', None)
+        if loaded is None or loaded[0] != obj.pk:
+            stats = getattr(obj, 'stats', None)
+            ids = [*filter(None, [stats.last_product_id]), *stats.top_product_ids] if stats else []
+            products = {}
+            if ids:
+                products = Product.objects.filter(pk__in=ids, is_deleted=False).select_related('main_image').in_bulk()
+            loaded = self._stats_products_cache = (obj.pk, stats, products)
+        return loaded[1:]
+
     def get_last_added_product(self, obj):
-        last_product = obj.products.filter(is_deleted=False).order_by('-created_at').first()
+        stats, products = self._stats_products(obj)
+        last_product = products.get(stats.last_product_id) if stats else None
         return ProductSerializer(last_product).data if last_product else None
 
     def get_most_popular_products(self, obj):
-        most_popular_products = obj.products.filter(is_deleted=False).annotate(total_orders=Count('orders')).order_by('-total_orders')[:6]
+        stats, products = self._stats_products(obj)
+        if stats is None:
+            return []
+        most_popular_products = [products[pk] for pk in stats.top_product_ids if pk in products]
         return ProductSerializer(most_popular_products, many=True).data
 
-    def create(self, validated_data):
-        user = self.context['user']
-        shop = self.context['prodshopuct']
-
-        review, created = ReviewShop.objects.update_or_create(
-            user=user,
-            shop=shop
-        )
-        if created:
-            shop.review_count = F('review_count') + 1
-            shop.save()
-        
-        return review
-        
 
 class ImageProductSerializer(serializers.ModelSerializer):
     image = serializers.ImageField(required=False, allow_null=True)
+    variants = ImageVariantsField('image', 'variants')
 
     class Meta:
         model = ImageProduct
-        fields = ('id', 'product', 'image', 'is_main_image')
+        fields = ('id', 'product', 'image', 'variants', 'is_main_image')
         read_only_fields = ('id', 'product')
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'product', 'filename', 'size', 'received', 'created_at')
+        read_only_fields = ('id', 'product', 'received', 'created_at')
+
+    def validate_size(self, value):
+        if not 0 < value <= MAX_SESSION_SIZE:
+            raise serializers.ValidationError(f"Size must be between 1 and {MAX_SESSION_SIZE} bytes.")
+        return value
     
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     avg_crowns = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
     main_image = serializers.SerializerMethodField()
+    main_image_variants = serializers.SerializerMethodField()
+    available = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Product
-        fields = ('id', 'title', 'description', 'price', 'quantity', 'discount', 
-                   'shop', 'category', 'views_count', 'avg_crowns', 'main_image')
-        read_only_fields = ('id', 'shop', 'views_count', 'main_image', 'avg_crowns')
+        fields = ('id', 'title', 'description', 'price', 'quantity', 'available', 'discount', 
+                   'shop', 'category', 'views_count', 'avg_crowns', 'main_image', 'main_image_variants')
+        read_only_fields = ('id', 'shop', 'views_count', 'main_image', 'main_image_variants', 'avg_crowns')
         extra_kwargs = {'description': {'write_only': True}, 'quantity': {'write_only': True}}
 
     
     def get_main_image(self, obj):
-        image = obj.images.filter(is_main_image=True).first()
-        if image:
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(image.image.url)
-            return image.image.url
-        return None
-
+        # Querysets feeding this serializer select_related('main_image').
+        if not obj.main_image_id:
+            return None
+        image = obj.main_image
+        request = self.context.get('request')
+        if request:
+            return request.build_absolute_uri(image.image.url)
+        return image.image.url
+
+    def get_main_image_variants(self, obj):
+        if not obj.main_image_id:
+            return None
+        return variant_urls(obj.main_image.image, obj.main_image.variants, self.context.get('request'))
 
     def create(self, validated_data):
         user = self.context['request'].user
@@ -127,6 +218,24 @@ class ProductSerializer(serializers.ModelSerializer):
             
         return Product.objects.create(shop=user_shop, **validated_data)
 
+class ProductImportRowSerializer(serializers.Serializer):
+    id = serializers.IntegerField(required=False, min_value=1)
+    title = serializers.CharField(required=False, max_length=100)
+    description = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    price = serializers.DecimalField(required=False, max_digits=10, decimal_places=2, min_value=Decimal('0'))
+    quantity = serializers.IntegerField(required=False, min_value=0)
+    discount = serializers.IntegerField(required=False, allow_null=True, min_value=0, max_value=100)
+    category = serializers.IntegerField(required=False, min_value=1)
+
+    def validate(self, attrs):
+        # Rows with an id update that product and may leave any column out.
+        if 'id' not in attrs:
+            missing = [name for name in ('title', 'price', 'category') if name not in attrs]
+            if missing:
+                raise serializers.ValidationError({name: ['This field is required.'] for name in missing})
+        return attrs
+
+
 class CommentProductSerializer(serializers.ModelSerializer):
     user = serializers.ReadOnlyField(source='user.first_name')
 
@@ -150,20 +259,38 @@ class CommentProductSerializer(serializers.ModelSerializer):
     
     
 
-class ProductDetailSerializer(serializers.ModelSerializer):
-    comments = CommentProductSerializer(many=True, read_only=True)
+class ProductDetailSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    comments = serializers.SerializerMethodField()
     images = ImageProductSerializer(many=True, read_only=True)
     shop_info = serializers.SerializerMethodField()
     category_info = serializers.SerializerMethodField()
     avg_crowns = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
+    frequently_bought_together = serializers.SerializerMethodField()
+    available = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Product
-        fields = ('id', 'title', 'description', 'price', 'quantity', 'discount', 
-                  'created_at', 'shop', 'category', 'views_count', 'comments', 
-                  'images', 'shop_info', 'category_info', 'avg_crowns')
-        read_only_fields = ('id', 'shop', 'views_count', 'created_at', 
-                           'comments', 'images', 'shop_info', 'category_info', 'avg_crowns')
+        fields = ('id', 'title', 'description', 'price', 'quantity', 'available', 'discount', 
+                  'created_at', 'shop', 'category', 'views_count', 'comments', 'comments_count',
+                  'images', 'shop_info', 'category_info', 'avg_crowns', 'frequently_bought_together')
+        read_only_fields = ('id', 'shop', 'views_count', 'created_at', 'comments_count',
+                           'comments', 'images', 'shop_info', 'category_info', 'avg_crowns',
+                           'frequently_bought_together')
+
+    expandable_fields = ('comments', 'images', 'shop_info', 'category_info', 'frequently_bought_together')
+    # The rest is paginated by the product comments endpoints.
+    comments_preview = 5
+
+    def get_comments(self, obj):
+        comments = obj.comments.select_related('user').order_by('-created_at', '-id')[:self.comments_preview]
+        return CommentProductSerializer(comments, many=True, context=self.context).data
+
+    def get_frequently_bought_together(self, obj):
+        # Precomputed by the build_recommendations command, read in rank order.
+        neighbors = (obj.neighbors.filter(neighbor__is_deleted=False).order_by('rank')
+                     .select_related('neighbor__main_image'))
+        products = [neighbor.neighbor for neighbor in neighbors]
+        return ProductSerializer(products, many=True, context=self.context).data
     
     def get_shop_info(self, obj):
         return ShopSerializer(obj.shop, context=self.context).data if obj.shop else None
@@ -183,7 +310,9 @@ class ProductDetailSerializer(serializers.ModelSerializer):
         return {
             'id': obj.category.id,
             'title': obj.category.title,
-            'avatar': avatar_url
+            'avatar': avatar_url,
+            'avatar_variants': variant_urls(obj.category.avatar, obj.category.avatar_variants,
+                                            self.context.get('request')),
         }
     
 class HistorySearchSerializer(serializers.ModelSerializer):
@@ -202,10 +331,12 @@ class CartSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.title', read_only=True)
     product_price = serializers.DecimalField(source='product.price', max_digits=10, decimal_places=2, read_only=True)
     total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    reserved_until = serializers.DateTimeField(source='reservation.expires_at', read_only=True, default=None)
 
     class Meta:
         model = Cart
-        fields = ('id', 'user', 'product', 'quantity', 'created_at', 'updated_at', 'product_name', 'product_price', 'total_price')
+        fields = ('id', 'user', 'product', 'quantity', 'created_at', 'updated_at', 'product_name', 'product_price',
+                  'total_price', 'reserved_until')
         read_only_fields = ('id', 'user')
     
     def validate(self, attrs):
@@ -214,9 +345,11 @@ class CartSerializer(serializers.ModelSerializer):
         user = self.context['request'].user
         
         existing_quantity = 0
-        if Cart.objects.filter(user=user, product=product).exists():
+        if self.instance is None and Cart.objects.filter(user=user, product=product).exists():
             existing_quantity = Cart.objects.get(user=user, product=product).quantity
             
+        # Units held by other carts are checked by reservations.hold(), which
+        # can release lapsed holds first.
         if product.quantity < (quantity + existing_quantity):
             raise serializers.ValidationError(f'Not enough quantity! Available: {product.quantity}')
         return attrs
@@ -226,20 +359,36 @@ class CartSerializer(serializers.ModelSerializer):
         product = validated_data.get('product')
         quantity = validated_data.get('quantity')
         
-        try:
-            cart_item = Cart.objects.get(user=user, product=product)
-            cart_item.quantity = F('quantity') + quantity
-            cart_item.save()
-            cart_item.refresh_from_db()  
-        except Cart.DoesNotExist:
-            cart_item = Cart.objects.create(
-                user=user,
-                product=product,
-                quantity=quantity
-            )
+        with transaction.atomic():
+            try:
+                cart_item = Cart.objects.get(user=user, product=product)
+                cart_item.quantity = F('quantity') + quantity
+                cart_item.save()
+                cart_item.refresh_from_db()  
+            except Cart.DoesNotExist:
+                cart_item = Cart.objects.create(
+                    user=user,
+                    product=product,
+                    quantity=quantity
+                )
+            self.hold(cart_item)
         
         return cart_item
 
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            if validated_data.get('product', instance.product) != instance.product:
+                reservations.release([instance])
+            instance = super().update(instance, validated_data)
+            self.hold(instance)
+        return instance
+
+    def hold(self, cart_item):
+        if not reservations.hold(cart_item, cart_item.quantity):
+            raise serializers.ValidationError(
+                f'Not enough quantity! Available: {Product.objects.get(pk=cart_item.product_id).available}'
+            )
+
 class OrderItemSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.title', read_only=True)
     class Meta:
@@ -267,7 +416,7 @@ class CreateOrderSerializer(serializers.Serializer):
     def validate(self, data):
         user = self.context['request'].user
         cart_ids = data.get('cart_ids')
-        queryset = Cart.objects.filter(user=user, product__is_deleted=False).select_related('product')
+        queryset = Cart.objects.filter(user=user, product__is_deleted=False).select_related('product', 'reservation')
 
         if cart_ids:
             cart_items = queryset.filter(id__in=cart_ids)
@@ -279,9 +428,10 @@ class CreateOrderSerializer(serializers.Serializer):
         if not cart_items.exists():
             raise serializers.ValidationError("Your cart is empty.")
         for item in cart_items:
-            if item.product.quantity < item.quantity:
+            available = item.product.available + reservations.held(item)
+            if available < item.quantity:
                 raise serializers.ValidationError(
-                    f"Product '{item.product.title}' only has {item.product.quantity} units left."
+                    f"Product '{item.product.title}' only has {available} units left."
                 )
 
         data['cart_items'] = cart_items
@@ -289,53 +439,45 @@ class CreateOrderSerializer(serializers.Serializer):
 
     def create(self, validated_data):
         user = self.context['request'].user
-        cart_items = validated_data['cart_items']
-
-        main_product = cart_items.first().product
+        cart_items = list(validated_data['cart_items'])
+
+        order_items_list = []
+        lines = {}
+        total_amount = 0
+        for cart_item in cart_items:
+            product = cart_item.product
+            discount_pct = Decimal(str(product.discount or 0))
+            unit_price_after_discount = product.price - product.price * (discount_pct / Decimal('100'))
+            item_total = unit_price_after_discount * cart_item.quantity
+            total_amount += item_total
+            order_items_list.append(OrderItem(
+                product=product,
+                quantity=cart_item.quantity,
+                price_at_purchase=unit_price_after_discount
+            ))
+            units, total = lines.get(product.id, (0, 0))
+            lines[product.id] = (units + cart_item.quantity, total + item_total)
 
         with transaction.atomic():
             order = Order.objects.create(
                 user=user,
-                product=main_product,
-                total_amount=0
+                product=cart_items[0].product,
+                total_amount=total_amount
             )
-
-            total_amount = 0
-            order_items_list = []
-
-            for cart_item in cart_items:
-                product = cart_item.product
-                product = Product.objects.select_for_update().get(id=product.id, is_deleted=False)
-
-                if product.quantity < cart_item.quantity:
-                    raise serializers.ValidationError(f"Not enough stock for {product.title}")
-
-                discount_val = getattr(product, 'discount', 0) or 0
-                discount_pct = Decimal(str(discount_val))
-                
-                unit_price = product.price
-                unit_discount = unit_price * (discount_pct / Decimal('100'))
-                unit_price_after_discount = unit_price - unit_discount
-                
-                item_total = unit_price_after_discount * cart_item.quantity
-                total_amount += item_total
-
-                order_items_list.append(
-                    OrderItem(
-                        order=order,
-                        product=product,
-                        quantity=cart_item.quantity,
-                        price_at_purchase=unit_price_after_discount
-                    )
-                )
-                product.quantity -= cart_item.quantity
-                product.save()
+            for order_item in order_items_list:
+                order_item.order = order
             OrderItem.objects.bulk_create(order_items_list)
-            order.total_amount = total_amount
-            order.save()
+            # Last, so the product rows stay locked only until the commit.
+            short = sell(lines, held=reservations.take(cart_items))
+            if short:
+                titles = ', '.join(item.product.title for item in cart_items if item.product.id in short)
+                raise serializers.ValidationError(f"Not enough stock for {titles}")
+            Cart.objects.filter(id__in=[item.id for item in cart_items]).delete()
+
+            invalidate_on_commit('product_list', *{tag for item in cart_items for tag in product_tags(item.product)})
             from .signals import start_bot_notification
             transaction.on_commit(lambda: start_bot_notification(order))
-            cart_items.delete()
+            transaction.on_commit(lambda: record_order(order))
 
         return order
     
@@ -354,54 +496,17 @@ class CrownProductSerializer(serializers.ModelSerializer):
         user = self.context['request'].user
         product = validated_data.get('product')
         crowns = validated_data.get('crowns')
-        crown_instance, created = CrownProduct.objects.update_or_create(
-            user=user,
-            product=product,
-            defaults={'crowns': crowns}
-        )
+        with transaction.atomic():
+            crown_instance = CrownProduct.objects.select_for_update().filter(user=user, product=product).first()
+            old_crowns = crown_instance.crowns if crown_instance else None
+            if crown_instance:
+                crown_instance.crowns = crowns
+                crown_instance.save(update_fields=['crowns'])
+            else:
+                crown_instance = CrownProduct.objects.create(user=user, product=product, crowns=crowns)
+            apply_crown_change(product, old_crowns, crowns)
         return crown_instance
 
-class ReviewProductSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = ReviewProduct
-        fields = ('id', 'product', 'user')
-        read_only_fields = ('id','product', 'user')
-
-    def create(self, validated_data):
-        user = self.context['user']
-        product = self.context['product']
-
-        review, created = ReviewProduct.objects.update_or_create(
-            user=user,
-            product=product
-        )
-        if created:
-            product.views_count = F('views_count') + 1
-            product.save()
-        
-        return review
-
-class ReviewShopSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = ReviewShop
-        fields = ('id', 'user', 'shop')
-        read_only_fields = ('id', 'user', 'shop')
-    
-    def create(self, validated_data):
-        user = self.context['user']
-        shop = self.context['shop']
-
-        review, created = ReviewShop.objects.update_or_create(
-            user = user,
-            shop=shop
-        )
-        if created:
-            shop.review_count = F('review_count') + 1
-            shop.save()
-        
-        return review
-    
-
 class ProfileInfoSerializer(serializers.Serializer):    
     user_info = serializers.SerializerMethodField()
     total_orders = serializers.SerializerMethodField()  
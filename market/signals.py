@@ -1,7 +1,156 @@
 import os
 import threading
 import asyncio
+from collections import Counter
 from django.conf import settings
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, post_delete
+from django.db import transaction
+from django.dispatch import receiver
+
+from . import images, search, stats
+from .caching import invalidate_on_commit
+from .suggest import suggest_index
+from .visual import descriptor_worker
+from .images import variant_pipeline
+from .storage import release, retain
+from .models import User, Product, Shop, ShopStats, Category, ImageProduct, CommentProduct, CrownProduct
+
+
+@receiver(post_save, sender=Product)
+def sync_product_search_index(sender, instance, **kwargs):
+    search.index_products([instance])
+
+
+@receiver(post_delete, sender=Product)
+def drop_product_search_index(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def sync_product_suggestions(sender, instance, **kwargs):
+    transaction.on_commit(lambda: suggest_index.update_product(instance))
+
+
+@receiver(post_delete, sender=Product)
+def drop_product_suggestions(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: suggest_index.remove_product(pk))
+
+
+@receiver(post_save, sender=Product)
+def update_shop_stats_on_save(sender, instance, created, **kwargs):
+    if created or instance.is_deleted:
+        shop_id = instance.shop_id
+        transaction.on_commit(lambda: stats.refresh_products(shop_id))
+
+
+@receiver(post_delete, sender=Product)
+def update_shop_stats_on_delete(sender, instance, **kwargs):
+    shop_id = instance.shop_id
+    transaction.on_commit(lambda: stats.refresh_products(shop_id))
+
+
+@receiver(post_save, sender=Shop)
+def create_shop_stats(sender, instance, created, **kwargs):
+    if created:
+        ShopStats.objects.get_or_create(shop=instance)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    invalidate_on_commit(f'product:{instance.pk}', f'shop:{instance.shop_id}', 'product_list')
+
+
+@receiver([post_save, post_delete], sender=Shop)
+def invalidate_shop_cache(sender, instance, **kwargs):
+    invalidate_on_commit(f'shop:{instance.pk}', 'shop_list')
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_cache(sender, instance, **kwargs):
+    # Product list pages and their facets embed category titles.
+    invalidate_on_commit(f'category:{instance.pk}', 'category_list', 'product_list')
+
+
+@receiver([post_save, post_delete], sender=ImageProduct)
+def invalidate_product_image_cache(sender, instance, **kwargs):
+    shop_id = Product.objects.filter(pk=instance.product_id).values_list('shop_id', flat=True).first()
+    invalidate_on_commit(f'product:{instance.product_id}', f'shop:{shop_id}', 'product_list')
+
+
+@receiver(post_save, sender=ImageProduct)
+def describe_product_image(sender, instance, created, **kwargs):
+    if created and instance.image:
+        pk = instance.pk
+        transaction.on_commit(lambda: descriptor_worker.add(pk))
+
+
+@receiver(post_save, sender=ImageProduct)
+@receiver(post_save, sender=Shop)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=User)
+def generate_image_variants(sender, instance, **kwargs):
+    if images.needs_variants(instance):
+        pk = instance.pk
+        transaction.on_commit(lambda: variant_pipeline.enqueue(sender, pk))
+
+
+@receiver(post_init, sender=ImageProduct)
+@receiver(post_init, sender=Shop)
+@receiver(post_init, sender=Category)
+@receiver(post_init, sender=User)
+def remember_media_files(sender, instance, **kwargs):
+    instance._media_files = images.instance_files(instance)
+
+
+@receiver(post_save, sender=ImageProduct)
+@receiver(post_save, sender=Shop)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=User)
+def count_media_references(sender, instance, **kwargs):
+    # Rows loaded with their image fields deferred are left to the sweep's recount.
+    before, after = getattr(instance, '_media_files', None), images.instance_files(instance)
+    if before is None or after is None:
+        return
+    instance._media_files = after
+    added = list((Counter(after) - Counter(before)).elements())
+    removed = list((Counter(before) - Counter(after)).elements())
+    if added or removed:
+        transaction.on_commit(lambda: (retain(added), release(removed)))
+
+
+@receiver(post_delete, sender=ImageProduct)
+@receiver(post_delete, sender=Shop)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=User)
+def release_media_files(sender, instance, **kwargs):
+    files = getattr(instance, '_media_files', None)
+    if files:
+        transaction.on_commit(lambda: release(files))
+
+
+@receiver(post_save, sender=CommentProduct)
+def count_new_comment(sender, instance, created, **kwargs):
+    if created:
+        Product.objects.filter(pk=instance.product_id).update(comments_count=F('comments_count') + 1)
+
+
+@receiver(post_delete, sender=CommentProduct)
+def count_deleted_comment(sender, instance, **kwargs):
+    Product.objects.filter(pk=instance.product_id).update(comments_count=F('comments_count') - 1)
+
+
+@receiver([post_save, post_delete], sender=CommentProduct)
+def invalidate_comment_cache(sender, instance, **kwargs):
+    invalidate_on_commit(f'product:{instance.product_id}')
+
+
+@receiver([post_save, post_delete], sender=CrownProduct)
+def invalidate_rating_cache(sender, instance, **kwargs):
+    invalidate_on_commit(
+        f'product:{instance.product_id}', f'shop:{instance.product.shop_id}', 'product_list', 'shop_list'
+    )
 
 
 def start_bot_notification(instance):
@@ -92,34 +241,3 @@ async def _send_telegram_async(seller_tg_id, products_str, customer_name, total_
         print(f"Bot Sending Error: {e}")
     finally:
         await bot.session.close()
-
-# from django.db.models.signals import post_save
-# from django.dispatch import receiver
-# from .models import ImageProduct, ProductImageEmbedding
-# from PIL import Image
-# from sentence_transformers import SentenceTransformer
-# import numpy as np
-#
-# try:
-#     embedding_model = SentenceTransformer('clip-ViT-B-32')
-# except Exception as e:
-#     print(f"Warning: Could not load embedding model: {e}")
-#     embedding_model = None
-#
-# @receiver(post_save, sender=ImageProduct)
-# def create_image_embedding(sender, instance, created, **kwargs):
-#     if created and instance.image and embedding_model:
-#         try:
-#             image_path = instance.image.path
-#             if not os.path.exists(image_path):
-#                  return
-#
-#             img = Image.open(image_path)
-#             embedding = embedding_model.encode(img)
-#
-#             ProductImageEmbedding.objects.create(
-#                 product_image=instance,
-#                 embedding=embedding.tolist()
-#             )
-#         except Exception as e:
-#             print(f"Error creating embedding for image {instance.id}: {e}")
\ No newline at end of file
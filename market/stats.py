@@ -0,0 +1,53 @@
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+
+from .caching import invalidate
+from .models import OrderItem, Product, Shop, ShopStats
+
+
+TOP_PRODUCTS = 6
+
+
+def _live_products(shop_id):
+    return Product.objects.filter(shop_id=shop_id, is_deleted=False)
+
+
+def top_product_ids(shop_id, limit=TOP_PRODUCTS):
+    return list(_live_products(shop_id).order_by('-units_sold', '-id').values_list('id', flat=True)[:limit])
+
+
+def refresh_products(shop_id):
+    """Recounts a shop's products after one was added or removed."""
+    last_product_id = _live_products(shop_id).order_by('-created_at', '-id').values_list('id', flat=True).first()
+    ShopStats.objects.update_or_create(shop_id=shop_id, defaults={
+        'total_products': _live_products(shop_id).count(),
+        'last_product_id': last_product_id,
+        'top_product_ids': top_product_ids(shop_id),
+    })
+
+
+def record_order(order):
+    shop_ids = set(OrderItem.objects.filter(order=order).values_list('product__shop_id', flat=True))
+    ShopStats.objects.filter(shop_id__in=shop_ids).update(total_orders=F('total_orders') + 1)
+    for shop_id in shop_ids:
+        ShopStats.objects.filter(shop_id=shop_id).update(top_product_ids=top_product_ids(shop_id))
+    invalidate(*[f'shop:{shop_id}' for shop_id in shop_ids])
+
+
+def rebuild_shop_stats():
+    products = dict(Product.objects.filter(is_deleted=False).order_by().values('shop_id')
+                    .annotate(total=Count('id')).values_list('shop_id', 'total'))
+    orders = dict(OrderItem.objects.order_by().values('product__shop_id')
+                  .annotate(total=Count('order', distinct=True)).values_list('product__shop_id', 'total'))
+    last_products = Shop.objects.annotate(last_product_id=Subquery(
+        Product.objects.filter(shop=OuterRef('pk'), is_deleted=False).order_by('-created_at', '-id').values('id')[:1]
+    )).values_list('id', 'last_product_id')
+    stats = [
+        ShopStats(shop_id=shop_id, total_products=products.get(shop_id, 0), total_orders=orders.get(shop_id, 0),
+                  last_product_id=last_product_id, top_product_ids=top_product_ids(shop_id))
+        for shop_id, last_product_id in last_products
+    ]
+    with transaction.atomic():
+        ShopStats.objects.all().delete()
+        ShopStats.objects.bulk_create(stats, batch_size=1000)
+    return len(stats)
@@ -0,0 +1,179 @@
+import datetime
+import hashlib
+import os
+import tempfile
+from collections import Counter, defaultdict
+
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db.models import F
+from django.utils import timezone
+
+
+BLOB_DIR = 'blobs'
+# Blobs nobody references are kept this long before a sweep deletes them,
+# so an upload whose row is not committed yet is not swept from under it.
+SWEEP_GRACE = datetime.timedelta(hours=1)
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_DIR + '/')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Stores each distinct file once, under the SHA-256 of its content.
+
+    ``save('product_additional_images/cat.jpg', upload)`` streams the upload
+    into a temporary file while hashing it and keeps it as
+    ``blobs/3f/a2/3fa2…e1.jpg``; saving the same bytes again, under any
+    name, returns the existing blob without writing anything. A blob's
+    content never changes, so its URL can be cached forever.
+
+    Every blob has a ``MediaBlob`` row counting the image fields that point
+    to it; ``sweep()`` deletes the ones nobody references.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The name is picked by _save from the content.
+        return name
+
+    def _save(self, name, content):
+        _, extension = os.path.splitext(name)
+        incoming = os.path.join(self.location, '.incoming')
+        os.makedirs(incoming, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=incoming, delete=False) as temporary:
+            try:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    temporary.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                temporary.close()
+                os.remove(temporary.name)
+                raise
+        hexdigest = digest.hexdigest()
+        name = f'{BLOB_DIR}/{hexdigest[:2]}/{hexdigest[2:4]}/{hexdigest}{extension.lower()}'
+        full_path = self.path(name)
+
+        # Registered before the file is checked: a sweep only deletes blobs
+        # whose row has been idle for SWEEP_GRACE.
+        _register(name, size)
+        if os.path.exists(full_path):
+            os.remove(temporary.name)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(temporary.name, full_path)
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+    def discard(self, name, still_wanted):
+        # Moved aside first, so a blob uploaded again while it was being
+        # swept can be put back.
+        full_path = self.path(name)
+        trash = os.path.join(self.location, '.incoming', os.path.basename(name) + '.deleted')
+        try:
+            os.replace(full_path, trash)
+        except FileNotFoundError:
+            return
+        if still_wanted() and not os.path.exists(full_path):
+            os.replace(trash, full_path)
+        else:
+            os.remove(trash)
+
+
+def _register(name, size=0):
+    from .models import MediaBlob
+
+    MediaBlob.objects.bulk_create([MediaBlob(name=name, size=size)], ignore_conflicts=True)
+    MediaBlob.objects.filter(name=name).update(updated_at=timezone.now())
+
+
+def _adjust(names, sign):
+    from .models import MediaBlob
+
+    counts = Counter(name for name in names if is_blob(name))
+    if not counts:
+        return
+    MediaBlob.objects.bulk_create([MediaBlob(name=name) for name in counts], ignore_conflicts=True)
+    groups = defaultdict(list)
+    for name, count in counts.items():
+        groups[count].append(name)
+    now = timezone.now()
+    for count, group in groups.items():
+        MediaBlob.objects.filter(name__in=group).update(refcount=F('refcount') + sign * count, updated_at=now)
+
+
+def retain(names):
+    _adjust(names, 1)
+
+
+def release(names):
+    _adjust(names, -1)
+
+
+def referenced_blobs():
+    """Counts the references to every blob from the rows holding images."""
+    from .images import image_sources, stored_files
+
+    counts = Counter()
+    for model, (image_field, variants_field) in image_sources().items():
+        rows = model.objects.values_list(image_field, variants_field).iterator(chunk_size=5000)
+        for name, variants in rows:
+            counts.update(name for name in stored_files(name, variants) if is_blob(name))
+    return counts
+
+
+def recount(storage=None):
+    """Resets every ``MediaBlob.refcount`` from the rows and the files on disk.
+
+    Live counting misses ``update()`` and bulk writes; blob files without a
+    row, left by a crash between writing and registering, get one here.
+    """
+    from .models import MediaBlob
+
+    storage = storage or default_storage
+    counts = referenced_blobs()
+    on_disk = {}
+    for directory, _, files in os.walk(storage.path(BLOB_DIR)):
+        relative = os.path.relpath(directory, storage.location).replace(os.sep, '/')
+        for file in files:
+            on_disk[f'{relative}/{file}'] = os.path.getsize(os.path.join(directory, file))
+
+    known = set(MediaBlob.objects.values_list('name', flat=True))
+    now = timezone.now()
+    MediaBlob.objects.bulk_create(
+        [MediaBlob(name=name, size=on_disk.get(name, 0), updated_at=now) for name in (set(counts) | set(on_disk)) - known],
+        batch_size=1000, ignore_conflicts=True,
+    )
+    changed = []
+    for blob in MediaBlob.objects.only('id', 'name', 'refcount', 'updated_at').iterator(chunk_size=5000):
+        refcount = counts.get(blob.name, 0)
+        if blob.refcount != refcount:
+            if refcount == 0:
+                blob.updated_at = now
+            blob.refcount = refcount
+            changed.append(blob)
+    MediaBlob.objects.bulk_update(changed, ['refcount', 'updated_at'], batch_size=1000)
+    return len(changed)
+
+
+def sweep(grace=SWEEP_GRACE, storage=None):
+    """Deletes blobs that nothing has referenced for ``grace``; returns (files, bytes)."""
+    from .models import MediaBlob
+
+    storage = storage or default_storage
+    cutoff = timezone.now() - grace
+    orphans = list(MediaBlob.objects.filter(refcount__lte=0, updated_at__lt=cutoff).values_list('id', 'name', 'size'))
+    files = freed = 0
+    for pk, name, size in orphans:
+        # Re-checked per row: the blob may have been uploaded again since.
+        if not MediaBlob.objects.filter(pk=pk, refcount__lte=0, updated_at__lt=cutoff).delete()[0]:
+            continue
+        storage.discard(name, still_wanted=lambda name=name: MediaBlob.objects.filter(name=name).exists())
+        files += 1
+        freed += size
+    return files, freed
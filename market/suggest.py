@@ -0,0 +1,188 @@
+import bisect
+import heapq
+import threading
+import time
+
+from django.db.models import Count, Q
+
+from .search import normalize_query
+
+
+class SuggestIndex:
+    """In-memory typeahead index.
+
+    Every product title, category title and popular search text is stored
+    under each of its word starts ("red usb cable" is also found by "usb" and
+    "cable"), in one sorted list of ``(text, kind, id)`` keys. A prefix lookup
+    is a bisect plus a short forward scan. Product saves patch a copy of the
+    list that then replaces it, so lookups never see a list being changed
+    and don't need the lock. The index is per process; it is
+    built in the background on the first request and rebuilt every
+    ``rebuild_interval`` seconds to pick up other workers' writes and new
+    popular searches. Until the first build is done it suggests nothing.
+
+    Short prefixes match most of the list, so only ``scan_limit`` keys are
+    looked at and answers are memoized until the next change.
+    """
+
+    kinds = ('product', 'category', 'query')
+
+    def __init__(self, rebuild_interval=600, scan_limit=1000, max_words=6, min_history_count=2,
+                 history_limit=5000, memo_size=10000):
+        self.rebuild_interval = rebuild_interval
+        self.scan_limit = scan_limit
+        self.max_words = max_words
+        self.min_history_count = min_history_count
+        self.history_limit = history_limit
+        self.memo_size = memo_size
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.keys = []
+        self.entries = {}
+        self.built_at = None
+        self.rebuilding = False
+
+    def _word_starts(self, text):
+        words = text.split()[:self.max_words]
+        return {' '.join(words[i:]) for i in range(len(words))}
+
+    def _collect(self):
+        from .models import Category, HistorySearch, Product
+
+        entries = {}
+        products = Product.objects.filter(is_deleted=False).values_list('id', 'title', 'views_count')
+        for pk, title, views in products.iterator(chunk_size=5000):
+            entries[('product', pk)] = (title, views)
+        categories = (Category.objects.filter(is_deleted=False)
+                      .annotate(total=Count('category_products', filter=Q(category_products__is_deleted=False)))
+                      .values_list('id', 'title', 'total'))
+        for pk, title, total in categories:
+            entries[('category', pk)] = (title, total)
+        history = (HistorySearch.objects.order_by().values('text').annotate(total=Count('id'))
+                   .filter(total__gte=self.min_history_count).order_by('-total')[:self.history_limit])
+        for row in history:
+            entries[('query', normalize_query(row['text']))] = (row['text'], row['total'])
+        return entries
+
+    def rebuild(self):
+        entries = self._collect()
+        keys = []
+        for (kind, ref), (text, _) in entries.items():
+            keys.extend((start, kind, ref) for start in self._word_starts(normalize_query(text)))
+        keys.sort()
+        with self.lock:
+            self.keys = keys
+            self.entries = entries
+            self.memo = {}
+            self.built_at = time.monotonic()
+            self.rebuilding = False
+
+    def _ensure_built(self):
+        if self.built_at is not None and time.monotonic() - self.built_at < self.rebuild_interval:
+            return
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        # Keep answering from the current list while the new one is built.
+        threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def warm(self, **kwargs):
+        # Connected to request_started, so the first build starts with the
+        # first request of a worker instead of inside a suggest call.
+        self._ensure_built()
+
+    def _rebuild_in_background(self):
+        from django.db import connection
+
+        try:
+            self.rebuild()
+        except Exception as error:
+            print(f"Suggest index build error: {error}")
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    def _replace_products(self, product_ids, products):
+        # Edits a copy and swaps it in with a single assignment; copying the
+        # list is a memcpy, far cheaper than lookups taking the lock.
+        keys = self.keys.copy()
+        for pk in product_ids:
+            entry = self.entries.pop(('product', pk), None)
+            if entry is None:
+                continue
+            for start in self._word_starts(normalize_query(entry[0])):
+                key = (start, 'product', pk)
+                index = bisect.bisect_left(keys, key)
+                if index < len(keys) and keys[index] == key:
+                    del keys[index]
+        added = []
+        for product in products:
+            self.entries[('product', product.pk)] = (product.title, product.views_count)
+            added.extend((start, 'product', product.pk)
+                         for start in self._word_starts(normalize_query(product.title)))
+        if len(added) > 32:
+            # Appending a batch and re-sorting is a linear merge of two runs.
+            keys.extend(added)
+            keys.sort()
+        else:
+            for key in added:
+                bisect.insort(keys, key)
+        self.keys = keys
+        self.memo = {}
+
+    def update_product(self, product):
+        self.update_products([product])
+
+    def update_products(self, products):
+        if self.built_at is None:
+            return
+        with self.lock:
+            self._replace_products([product.pk for product in products],
+                                   [product for product in products if not product.is_deleted])
+
+    def remove_product(self, product_id):
+        if self.built_at is None:
+            return
+        with self.lock:
+            self._replace_products([product_id], [])
+
+    def suggest(self, prefix, limit=10):
+        prefix = normalize_query(prefix)
+        if not prefix:
+            return []
+        self._ensure_built()
+        memo = self.memo
+        results = memo.get((prefix, limit))
+        if results is None:
+            results = self._lookup(prefix, limit)
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            memo[(prefix, limit)] = results
+        return results
+
+    def _lookup(self, prefix, limit):
+        keys, entries = self.keys, self.entries
+        candidates = {}
+        index = bisect.bisect_left(keys, (prefix,))
+        for start, kind, ref in keys[index:index + self.scan_limit]:
+            if not start.startswith(prefix):
+                break
+            entry = entries.get((kind, ref))
+            if entry is not None:
+                candidates[(kind, ref)] = entry
+
+        best = heapq.nlargest(limit * 2, candidates.items(), key=lambda item: item[1][1])
+        results, seen = [], set()
+        for (kind, ref), (text, _) in best:
+            folded = text.casefold()
+            if folded in seen:
+                continue
+            seen.add(folded)
+            results.append({'text': text, 'kind': kind, 'id': ref if kind != 'query' else None})
+            if len(results) == limit:
+                break
+        return results
+
+
+suggest_index = SuggestIndex()
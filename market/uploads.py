@@ -0,0 +1,173 @@
+import datetime
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+
+from . import caching
+from .images import variant_pipeline
+from .storage import retain
+from .visual import descriptor_worker
+
+
+MAX_FILES = 20
+MAX_FILE_SIZE = 10 * 1024 * 1024
+# Chunked uploads are written to disk as they arrive, so they may be larger.
+MAX_SESSION_SIZE = 50 * 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+SESSION_MAX_AGE = datetime.timedelta(days=1)
+FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+VERIFY_WORKERS = 4
+# Larger images are refused before anything tries to decode them.
+MAX_PIXELS = 40 * 1000 * 1000
+
+
+def session_dir():
+    return getattr(settings, 'UPLOAD_SESSION_DIR', os.path.join(settings.BASE_DIR, 'uploads'))
+
+
+def verify_image(fp):
+    """Returns None for a readable image in an accepted format, else the reason.
+
+    Only the headers and structure are checked, nothing is decoded; a file
+    that is damaged past that fails when its variants are rendered.
+    """
+    try:
+        with Image.open(fp) as image:
+            image_format, (width, height) = image.format, image.size
+            image.verify()
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        return 'Upload a valid image.'
+    finally:
+        fp.seek(0)
+    if image_format not in FORMATS:
+        return f'{image_format} images are not supported.'
+    if width * height > MAX_PIXELS:
+        return 'The image is too large.'
+    return None
+
+
+def verify_images(files):
+    """``verify_image`` for every file, checked in parallel (Pillow releases the GIL)."""
+    with ThreadPoolExecutor(max_workers=min(VERIFY_WORKERS, len(files) or 1)) as pool:
+        return list(pool.map(verify_image, files))
+
+
+def store(files):
+    from .models import ImageProduct
+
+    field = ImageProduct._meta.get_field('image')
+    return [default_storage.save(field.generate_filename(None, os.path.basename(file.name)), file) for file in files]
+
+
+def create_images(product, names, main_index=None):
+    """Adds stored files to a product with one insert.
+
+    Replaces ``ImageProduct.save`` for a batch: at most one image becomes
+    the main one, with a single sibling update. ``bulk_create`` skips model
+    signals, so their work (references, variants, descriptors, caches) is
+    done here.
+    """
+    from .models import ImageProduct, Product
+
+    now = timezone.now()
+    with transaction.atomic():
+        images = ImageProduct.objects.bulk_create([
+            ImageProduct(product=product, image=name, is_main_image=index == main_index)
+            for index, name in enumerate(names)
+        ])
+        if main_index is not None:
+            main = images[main_index]
+            ImageProduct.objects.filter(product=product, is_main_image=True).exclude(pk=main.pk).update(
+                is_main_image=False)
+            Product.objects.filter(pk=product.pk).update(main_image=main, updated_at=now)
+        else:
+            Product.objects.filter(pk=product.pk).update(updated_at=now)
+
+        def after_commit():
+            retain(names)
+            for image in images:
+                variant_pipeline.enqueue(ImageProduct, image.pk)
+                descriptor_worker.add(image.pk)
+            caching.invalidate(f'product:{product.pk}', f'shop:{product.shop_id}', 'product_list')
+
+        transaction.on_commit(after_commit)
+    return images
+
+
+def part_path(session):
+    return os.path.join(session_dir(), f'{session.pk}.part')
+
+
+def write_chunk(session, offset, stream, length):
+    """Appends one chunk of a resumable upload; returns the new offset or None.
+
+    The request body is spooled to a temporary file in small pieces, so a
+    chunk never sits in memory as a whole. It is copied into the part file
+    only after the conditional update of ``received`` succeeded, while that
+    update keeps the session row locked, so two requests sending the same
+    offset can't both write. None means another request wrote at this
+    offset first.
+    """
+    from .models import UploadSession
+
+    os.makedirs(session_dir(), exist_ok=True)
+    with tempfile.TemporaryFile(dir=session_dir()) as chunk:
+        received = offset
+        while received < offset + length:
+            piece = stream.read(min(offset + length - received, 64 * 1024))
+            if not piece:
+                break
+            chunk.write(piece)
+            received += len(piece)
+        chunk.seek(0)
+        with transaction.atomic():
+            if not UploadSession.objects.filter(pk=session.pk, received=offset).update(received=received,
+                                                                                      updated_at=timezone.now()):
+                return None
+            path = part_path(session)
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as part:
+                part.seek(offset)
+                shutil.copyfileobj(chunk, part, 64 * 1024)
+    return received
+
+
+def complete(session, main=False):
+    """Verifies a finished upload and adds it to the product; returns (image, error)."""
+    from .models import ImageProduct
+
+    path = part_path(session)
+    with open(path, 'rb') as part:
+        error = verify_image(part)
+        if error:
+            return None, error
+        name = ImageProduct._meta.get_field('image').generate_filename(None, os.path.basename(session.filename))
+        # Streams the part file through the storage in chunks.
+        name = default_storage.save(name, File(part, name=session.filename))
+    images = create_images(session.product, [name], 0 if main else None)
+    discard(session)
+    return images[0], None
+
+
+def discard(session):
+    try:
+        os.remove(part_path(session))
+    except FileNotFoundError:
+        pass
+    session.delete()
+
+
+def expire_sessions(max_age=SESSION_MAX_AGE):
+    from .models import UploadSession
+
+    expired = list(UploadSession.objects.filter(updated_at__lt=timezone.now() - max_age))
+    for session in expired:
+        discard(session)
+    return len(expired)
@@ -2,13 +2,14 @@ from django.urls import path
 from .views import (
     CategoryListView, CategoryDetailView, CategoryPutView, CategoryDestroyView, CategoryCreateView,
     ShopListView, ShopDetailView, ShopCreateView, ShopPutView, ShopDestroyView, GetMyShop,
-    ProductListView, ProductCreateView, ProductPutView, ProductDestroyView, ProductDetailView, ProductImageAddView, ProductImageDestroyView,
+    ProductListView, ProductSuggestView, ProductCreateView, ProductImportView, ProductPutView, ProductDestroyView, ProductDetailView, ProductImageAddView, ProductImageBatchAddView, ProductImageDestroyView,
+    ImageUploadCreateView, ImageUploadView, ImageUploadCompleteView,
     ProfileInfoView, CartCreateView, CartListView, CartDetailView, CartDestroyView, CartUpdateView,
-    OrderListView, OrderDetailView, CreateOrderView,  CommentDestroyView, CommentUpdateView, CommentListView,
+    OrderListView, OrderDetailView, CreateOrderView, OrderExportView,  CommentDestroyView, CommentUpdateView, CommentListView,
     MyCommentsListView, CommentDetailView,
     HistoryUserView, HistoryCreateView, HistoryDestroyView, CrownProductView,
-    CommentsProduct, CommentsToProduct,
-    # AISearchView
+    CommentsProduct, CommentsToProduct, CacheStatsView,
+    VisualSearchView,
 )
 
 app_name = 'market'
@@ -36,12 +37,18 @@ urlpatterns = [
 
     #  ----- Product api
     path('products/get-all-products/', ProductListView.as_view(), name='product-list'),
+    path('products/suggest/', ProductSuggestView.as_view(), name='product-suggest'),
     path('products/get-by-id/<int:pk>/', ProductDetailView.as_view(), name='product-detail'),
     path('products/create/', ProductCreateView.as_view(), name='product-create'),
+    path('products/import/', ProductImportView.as_view(), name='product-import'),
     path('products/<int:pk>/update/', ProductPutView.as_view(), name='product-update'),
     path('products/<int:pk>/destroy/', ProductDestroyView.as_view(), name='product-delete'),
     path('products/<int:pk>/add-image/', ProductImageAddView.as_view(), name='product-image-add'),
+    path('products/<int:pk>/add-images/', ProductImageBatchAddView.as_view(), name='product-image-batch-add'),
     path('products/delete-image/<int:pk>/', ProductImageDestroyView.as_view(), name='product-image-delete'),
+    path('products/<int:pk>/image-uploads/', ImageUploadCreateView.as_view(), name='image-upload-create'),
+    path('image-uploads/<uuid:pk>/', ImageUploadView.as_view(), name='image-upload'),
+    path('image-uploads/<uuid:pk>/complete/', ImageUploadCompleteView.as_view(), name='image-upload-complete'),
 
     # ----- Cart
     path('cart/get-all-items/', CartListView.as_view(), name='cart-list'),
@@ -54,6 +61,7 @@ urlpatterns = [
     path('order/get-all-orders/', OrderListView.as_view(), name='order-list'),
     path('order/create/', CreateOrderView.as_view(), name='order-create'),
     path('order/get-by-id/<int:pk>/', OrderDetailView.as_view(), name='order-detail'),
+    path('order/export/', OrderExportView.as_view(), name='order-export'),
     
     # -- History
     path('history/get-all-items/', HistoryUserView.as_view(), name='history-list'),
@@ -63,8 +71,8 @@ urlpatterns = [
     # -- Crowns
     path('crowns/add/<int:pk>/', CrownProductView.as_view(), name='crown-add'),
 
-    # # -- AI Search
-    # path('ai-search/', AISearchView.as_view(), name='ai-search'),
+    # -- Visual Search
+    path('visual-search/', VisualSearchView.as_view(), name='visual-search'),
 
     # -- Comments
     path('comments/products/<int:pk>/', CommentsProduct.as_view(), name='product-comments-list'),
@@ -74,6 +82,9 @@ urlpatterns = [
     path('comments/product/<int:product_id>/', CommentListView.as_view(), name='comment-list'),
     path('comments/<int:pk>/detail/', CommentDetailView.as_view(), name='comment-detail'),
 
+    # -- Cache
+    path('cache/stats/', CacheStatsView.as_view(), name='cache-stats'),
+
 
 
 ]
\ No newline at end of file
@@ -1,28 +1,55 @@
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.throttling import UserRateThrottle
 
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
-from django.db.models import Avg, Count, DecimalField
+from django.db.models import Count
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db.models.functions import Coalesce
 from django.db.models import Q
-from django.core.cache import cache
-from django.db import transaction
 
-
-from .permissions import IsAdmin, IsOwnerProduct, IsOwnerShop, IsOwnerImageProduct, IsSeller
+from .permissions import IsAdmin, IsAdminHard, IsOwnerProduct, IsOwnerShop, IsOwnerImageProduct, IsSeller, IsSellerHard
+from .paginations import CommentCursorPagination, ProductCursorPagination
+from . import search, caching, exports, imports, reservations, uploads, visual
+from .suggest import suggest_index
+from .buffers import history_buffer
+from .counters import product_views, shop_views
 from .models import (Category, Shop, Product, ReviewProduct, ImageProduct, CommentProduct,
-                     CrownProduct, ReviewShop, Cart, Order, HistorySearch)
+                     CrownProduct, ReviewShop, Cart, Order, HistorySearch, ImageDescriptor, UploadSession)
 from .serializer import (CategorySerializer, ShopSerializer, ProductSerializer,
-                         ProductDetailSerializer, ReviewProductSerializer, ReviewShopSerializer,
+                         ProductDetailSerializer,
                          ShopDetailSerializer, ImageProductSerializer, ProfileInfoSerializer,
                          CommentProductSerializer, CartSerializer, OrderSerializer, OrderItemSerializer, CreateOrderSerializer,
                          HistorySearchSerializer,
-                         CrownProductSerializer, CommentSerializer)
+                         CrownProductSerializer, CommentSerializer, UploadSessionSerializer)
+
+FIELD_PARAMETERS = [
+    openapi.Parameter('fields', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                      description='Comma separated fields to return'),
+    openapi.Parameter('expand', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                      description='Comma separated expensive fields to add'),
+]
+
+
+class SparseFieldsViewMixin:
+    def get_selected_fields(self):
+        if not hasattr(self, '_selected_fields'):
+            self._selected_fields = self.get_serializer_class().select_fields(self.request.query_params)
+        return self._selected_fields
+
+    def wants_field(self, name):
+        fields = self.get_selected_fields()
+        return fields is None or name in fields
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_selected_fields())
+        return super().get_serializer(*args, **kwargs)
+
 
 class ShopListCreateView(generics.ListCreateAPIView):
     serializer_class = ShopSerializer
@@ -33,33 +60,23 @@ class ShopListCreateView(generics.ListCreateAPIView):
         if getattr(self, 'swagger_fake_view', False):
             return Shop.objects.none()
         return Shop.objects.filter(is_deleted=False).annotate(
-            avg_crowns=Coalesce(
-                Avg('products__product_crowns__crowns'),
-                0,
-                output_field=DecimalField()
-            ),
             total_products=Count('products', distinct=True),
             total_orders=Count('products__orders', distinct=True)
         ).select_related('seller')
     
     @swagger_auto_schema(tags=['Shop'])
     def get(self, request, *args, **kwargs):
-        cache_key = 'shop_list'
-        data = cache.get(cache_key)
-        if not data:
-            serializer = self.get_serializer(self.get_queryset(), many=True)
-            data = serializer.data
-            cache.set(cache_key, data, 60)
-        return Response(data)
+        return caching.cached_response(
+            request, 'shop_list', ['shop_list'],
+            lambda: self.get_serializer(self.get_queryset(), many=True).data
+        )
     
     @swagger_auto_schema(
         tags=['Shop'],
         consumes=['multipart/form-data'],
     )
     def post(self, request, *args, **kwargs):
-        response = super().post(request, *args, **kwargs)
-        cache.clear()
-        return response
+        return super().post(request, *args, **kwargs)
     
 class CategoryListView(generics.ListAPIView):
     serializer_class = CategorySerializer
@@ -74,13 +91,10 @@ class CategoryListView(generics.ListAPIView):
     
     @swagger_auto_schema(tags=['Category'], consumes=['multipart/form-data']) 
     def get(self, request, *args, **kwargs):
-        cache_key = 'category_list'
-        data = cache.get(cache_key)
-        if not data:
-            serializer = self.get_serializer(self.get_queryset(), many=True)
-            data = serializer.data
-            cache.set(cache_key, data, 60)
-        return Response(data)
+        return caching.cached_response(
+            request, 'category_list', ['category_list'],
+            lambda: self.get_serializer(self.get_queryset(), many=True).data
+        )
 
 class CategoryDetailView(generics.RetrieveAPIView):
     serializer_class = CategorySerializer
@@ -99,7 +113,6 @@ class CategoryCreateView(generics.CreateAPIView):
     
     @swagger_auto_schema(tags=['Category'], consumes=['multipart/form-data']) 
     def post(self, request, *args, **kwargs):
-        cache.clear()
         return super().post(request, *args, **kwargs)
   
 class CategoryPutView(generics.UpdateAPIView):
@@ -110,7 +123,6 @@ class CategoryPutView(generics.UpdateAPIView):
     
     @swagger_auto_schema(tags=['Category'], consumes=['multipart/form-data']) 
     def put(self, request, *args, **kwargs):
-        cache.clear()
         return super().put(request, *args, **kwargs)  
     
 class CategoryDestroyView(generics.DestroyAPIView):
@@ -120,7 +132,6 @@ class CategoryDestroyView(generics.DestroyAPIView):
     
     @swagger_auto_schema(tags=['Category'], consumes=['multipart/form-data']) 
     def delete(self, request, *args, **kwargs):
-        cache.clear()
         return super().delete(request, *args, **kwargs)
 
 class ShopListView(generics.ListAPIView):
@@ -130,49 +141,36 @@ class ShopListView(generics.ListAPIView):
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             return Shop.objects.none()
-        return Shop.objects.filter(is_deleted=False).annotate(
-            avg_crowns=Coalesce(
-                Avg('products__product_crowns__crowns'),
-                0,
-                output_field=DecimalField()
-            )
-        ).select_related('seller')
+        return Shop.objects.filter(is_deleted=False).select_related('seller')
 
     
     @swagger_auto_schema(tags=['Shop'], consumes=['multipart/form-data'])  
     def get(self, request, *args, **kwargs):
-        cache_key = 'shop_list'
-        data = cache.get(cache_key)
-        if not data:
-            serializer = self.get_serializer(self.get_queryset(), many=True)
-            data = serializer.data
-            cache.set(cache_key, data, 60)
-        return Response(data)
-    
-class ShopDetailView(generics.RetrieveAPIView):
+        return caching.cached_response(
+            request, 'shop_list', ['shop_list'],
+            lambda: self.get_serializer(self.get_queryset(), many=True).data
+        )
+    
+class ShopDetailView(SparseFieldsViewMixin, generics.RetrieveAPIView):
     serializer_class = ShopDetailSerializer
     permission_classes = [permissions.AllowAny]  
     queryset = Shop.objects.filter(is_deleted=False)
     
-    @swagger_auto_schema(tags=['Shop'], consumes=['multipart/form-data'])  
+    @swagger_auto_schema(tags=['Shop'], consumes=['multipart/form-data'], manual_parameters=FIELD_PARAMETERS)
     def get(self, request, *args, **kwargs):
         pk = kwargs.get('pk')
-        shop = get_object_or_404(Shop, pk=pk, is_deleted=False)
-        cache_key = f'shop_detail_{pk}'
-        data = cache.get(cache_key)
-        if not data:
-            serializer = self.get_serializer(shop)
-            data = serializer.data
-            cache.set(cache_key, data, 60)
-        
+        queryset = Shop.objects.filter(is_deleted=False).select_related('stats')
+        if self.wants_field('seller_full_name'):
+            queryset = queryset.select_related('seller')
+        shop = get_object_or_404(queryset, pk=pk)
         if request.user.is_authenticated:
-            serializer_reviews = ReviewShopSerializer(
-                context = {'user': request.user, 'shop': shop},
-                data = {'user': request.user.id, 'shop': shop.id}
-            )
-            if serializer_reviews.is_valid():
-                serializer_reviews.save()
-        return Response(data)
+            shop_views.add(request.user.id, shop.id)
+        fields = self.get_selected_fields()
+        return caching.cached_response(
+            request, 'shop_detail', [f'shop:{pk}'],
+            lambda: self.get_serializer(shop).data,
+            parts=[fields] if fields is not None else ()
+        )
 
 class ShopCreateView(generics.CreateAPIView):
     serializer_class = ShopSerializer
@@ -182,7 +180,6 @@ class ShopCreateView(generics.CreateAPIView):
     
     @swagger_auto_schema(tags=['Shop'], consumes=['multipart/form-data'])  
     def post(self, request, *args, **kwargs):
-        cache.clear()
         return super().post(request, *args, **kwargs)
 
 class ShopPutView(generics.UpdateAPIView):
@@ -193,7 +190,6 @@ class ShopPutView(generics.UpdateAPIView):
     
     @swagger_auto_schema(tags=['Shop'], consumes=['multipart/form-data'])  
     def put(self, request, *args, **kwargs):
-        cache.clear()
         user = request.user
         instance = self.get_object()
         if instance.seller != user and not user.is_staff:
@@ -208,7 +204,6 @@ class ShopDestroyView(generics.DestroyAPIView):
     
     @swagger_auto_schema(tags=['Shop'], consumes=['multipart/form-data'])  
     def delete(self, request, *args, **kwargs):
-        cache.clear()
         return super().delete(request, *args, **kwargs)
     
 
@@ -219,7 +214,7 @@ class GetMyShop(generics.RetrieveAPIView):
     @swagger_auto_schema(tags=['Shop'], consumes=['multipart/form-data'])
     def get(self, request, *args, **kwargs):
         user = request.user
-        shop = Shop.objects.filter(seller=user).first()
+        shop = Shop.objects.filter(seller=user).select_related('seller', 'stats').first()
         if not shop:
             return Response({'detail': 'You do not have a shop.'}, status=status.HTTP_404_NOT_FOUND)
         serializer = self.get_serializer(shop)
@@ -230,54 +225,116 @@ class GetMyShop(generics.RetrieveAPIView):
 
 
 
-class ProductListView(generics.ListAPIView):
+class ProductListView(SparseFieldsViewMixin, generics.ListAPIView):
     serializer_class = ProductSerializer
     permission_classes = [permissions.AllowAny]
+    pagination_class = ProductCursorPagination
 
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             return Product.objects.none()
-        queryset = Product.objects.filter(is_deleted=False).annotate(
-            avg_crowns=Coalesce(
-                Avg('product_crowns__crowns'),
-                0,
-                output_field=DecimalField()
-            )
-        ).select_related('shop')
-        query = self.request.query_params.get('query', '')
-        category = self.request.query_params.get('category', '')
-        max_price = self.request.query_params.get('max_price', '')
-        min_price = self.request.query_params.get('min_price', '')
+        queryset = Product.objects.filter(is_deleted=False)
+        if self.wants_field('main_image') or self.wants_field('main_image_variants'):
+            queryset = queryset.select_related('main_image')
+        filters = self.get_filters()
+        query = filters.get('query')
 
         if query:
-            queryset = queryset.filter(Q(title__icontains=query) | Q(description__icontains=query))
-            if self.request.user.is_authenticated:
-                try:
-                    history = HistorySearch.objects.create(user=self.request.user, text=query)
-                    history.save()
-                except Exception:
-                    pass
-        if category:
-            queryset = queryset.filter(category=category)
-        if max_price:
-            queryset = queryset.filter(price__lte=max_price)
-        if min_price:
-            queryset = queryset.filter(price__gte=min_price)
+            if search.is_available():
+                queryset = search.filter_products(queryset, query)
+            else:
+                queryset = queryset.filter(Q(title__icontains=query) | Q(description__icontains=query))
+        if 'category' in filters:
+            queryset = queryset.filter(category=filters['category'])
+        if 'max_price' in filters:
+            queryset = queryset.filter(price__lte=filters['max_price'])
+        if 'min_price' in filters:
+            queryset = queryset.filter(price__gte=filters['min_price'])
 
 
         return queryset
-    @swagger_auto_schema(tags=['Product'], consumes=['multipart/form-data'])
+    @swagger_auto_schema(
+        tags=['Product'],
+        consumes=['multipart/form-data'],
+        manual_parameters=[
+            openapi.Parameter('query', openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter('category', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter('min_price', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter('max_price', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter('sort', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              enum=list(ProductCursorPagination.sort_modes)),
+            openapi.Parameter('cursor', openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter('page_size', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter('facets', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                              description='Add category counts, price histogram and discount count'),
+            *FIELD_PARAMETERS,
+        ]
+    )
     def get(self, request, *args, **kwargs):
-        params = request.query_params.urlencode()
-        cache_key = f'product_list_{params}' if params else 'product_list_all'
-        data = cache.get(cache_key)
-        if not data:
-            serializer = self.get_serializer(self.get_queryset(), many=True)
-            data = serializer.data
-            cache.set(cache_key, data, 60)
-        return Response(data)
-
-class ProductDetailView(generics.RetrieveAPIView):
+        filters = self.get_filters()
+        if 'query' in filters and request.user.is_authenticated:
+            history_buffer.add(request.user.id, filters['query'])
+        response = caching.cached_response(
+            request, 'product_list', ['product_list'], self.get_page_data,
+            parts=self.get_cache_parts(filters),
+            admission=caching.search_admission if 'query' in filters else None
+        )
+        if response.status_code == status.HTTP_200_OK:
+            response.data = self.paginator.add_links(request, response.data)
+        return response
+
+    def get_filters(self):
+        if not hasattr(self, '_filters'):
+            self._filters = search.parse_product_filters(self.request.query_params)
+        return self._filters
+
+    def get_cache_parts(self, filters):
+        # Same page, same key: parameter order, query spelling and unknown
+        # parameters must not split one result into several cache entries.
+        params = self.request.query_params
+        paginator = self.paginator
+        sort = params.get(paginator.sort_query_param)
+        return [
+            sorted(filters.items()),
+            sort if sort in paginator.sort_modes else '',
+            params.get(paginator.cursor_query_param, ''),
+            paginator.get_page_size(self.request),
+            self.wants_facets(),
+            self.get_selected_fields(),
+        ]
+
+    def get_page_data(self):
+        queryset = self.get_queryset()
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        data = self.paginator.get_page_data(serializer.data)
+        if self.wants_facets():
+            data['facets'] = search.product_facets(queryset)
+        return data
+
+    def wants_facets(self):
+        return self.request.query_params.get('facets', '').lower() in ('1', 'true', 'yes')
+
+class ProductSuggestView(APIView):
+    permission_classes = [permissions.AllowAny]
+    default_limit = 10
+    max_limit = 20
+
+    @swagger_auto_schema(
+        tags=['Product'],
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True),
+            openapi.Parameter('limit', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+        ]
+    )
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = min(max(int(request.query_params.get('limit', self.default_limit)), 1), self.max_limit)
+        except ValueError:
+            limit = self.default_limit
+        return Response({'results': suggest_index.suggest(request.query_params.get('q', ''), limit)})
+
+class ProductDetailView(SparseFieldsViewMixin, generics.RetrieveAPIView):
     serializer_class = ProductDetailSerializer
     queryset = Product.objects.all()
     permission_classes = [permissions.AllowAny]
@@ -285,33 +342,28 @@ class ProductDetailView(generics.RetrieveAPIView):
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             return Product.objects.none()
-        return Product.objects.filter(is_deleted=False).annotate(
-            avg_crowns=Coalesce(
-                Avg('product_crowns__crowns'),
-                0,
-                output_field=DecimalField()
-            )
-        ).select_related('shop', 'category').prefetch_related('comments', 'images')
+        queryset = Product.objects.filter(is_deleted=False)
+        related = [name for field, name in (('shop_info', 'shop'), ('category_info', 'category'))
+                   if self.wants_field(field)]
+        if related:
+            queryset = queryset.select_related(*related)
+        if self.wants_field('images'):
+            queryset = queryset.prefetch_related('images')
+        return queryset
     
-    @swagger_auto_schema(tags=['Product'], consumes=['multipart/form-data'])
+    @swagger_auto_schema(tags=['Product'], consumes=['multipart/form-data'], manual_parameters=FIELD_PARAMETERS)
     def get(self, request, *args, **kwargs):
-        instance = self.get_object()
-        pk = instance.pk
-        cache_key = f'product_detail_{pk}'
-        data = cache.get(cache_key)
-        if not data:
-            serializer = self.get_serializer(instance)
-            data = serializer.data
-            cache.set(cache_key, data, 60)
-
+        instance = get_object_or_404(
+            Product.objects.only('id', 'shop_id', 'category_id'), pk=kwargs.get('pk'), is_deleted=False
+        )
         if request.user.is_authenticated:
-            serializer_reviews = ReviewProductSerializer(
-                context = {'user': request.user, 'product': instance},
-                data = {'user': request.user.id, 'product': instance.id}
-            )
-            if serializer_reviews.is_valid():
-                serializer_reviews.save()
-        return Response(data)
+            product_views.add(request.user.id, instance.id)
+        fields = self.get_selected_fields()
+        return caching.cached_response(
+            request, 'product_detail', caching.product_tags(instance),
+            lambda: self.get_serializer(self.get_object()).data,
+            parts=[fields] if fields is not None else ()
+        )
 
 class ProductCreateView(generics.CreateAPIView):
     serializer_class = ProductSerializer
@@ -321,9 +373,35 @@ class ProductCreateView(generics.CreateAPIView):
     
     @swagger_auto_schema(tags=['Product'], consumes=['multipart/form-data'])
     def post(self, request, *args, **kwargs):
-        cache.clear()
         return super().post(request, *args, **kwargs)
 
+class ProductImportView(APIView):
+    permission_classes = [IsSellerHard]
+    parser_classes = [MultiPartParser, FormParser]
+
+    @swagger_auto_schema(
+        tags=['Product'],
+        consumes=['multipart/form-data'],
+        manual_parameters=[
+            openapi.Parameter('file', openapi.IN_FORM, type=openapi.TYPE_FILE, required=True,
+                              description='CSV with a header row, or NDJSON with one product per line. '
+                                          'Columns: id (to update), title, description, price, quantity, '
+                                          'discount, category'),
+        ]
+    )
+    def post(self, request, *args, **kwargs):
+        shop = Shop.objects.filter(seller=request.user, is_deleted=False).first()
+        if not shop:
+            return Response({'detail': 'You must create a shop first.'}, status=status.HTTP_400_BAD_REQUEST)
+        upload = request.FILES.get('file')
+        if not upload:
+            return Response({'detail': 'No file was uploaded.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            rows = imports.read_rows(upload)
+        except ValueError as error:
+            return Response({'detail': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(imports.ProductImport(shop).run(rows))
+
 class ProductPutView(generics.UpdateAPIView):
     serializer_class = ProductSerializer
     queryset = Product.objects.all()
@@ -332,7 +410,6 @@ class ProductPutView(generics.UpdateAPIView):
     
     @swagger_auto_schema(tags=['Product'], consumes=['multipart/form-data'])
     def put(self, request, *args, **kwargs):
-        cache.clear()
         return super().put(request, *args, **kwargs)
 
 class ProductDestroyView(generics.DestroyAPIView):
@@ -342,9 +419,14 @@ class ProductDestroyView(generics.DestroyAPIView):
     
     @swagger_auto_schema(tags=['Product'], consumes=['multipart/form-data'])
     def delete(self, request, *args, **kwargs):
-        cache.clear()
         return super().delete(request, *args, **kwargs)
 
+def get_editable_product(request, pk):
+    product = get_object_or_404(Product.objects.select_related('shop'), id=pk, is_deleted=False)
+    if not (request.user.role == 'AD' or request.user.is_staff or product.shop.seller_id == request.user.id):
+        raise PermissionDenied('You do not have permission to add images to this product.')
+    return product
+
 class ProductImageAddView(generics.CreateAPIView):
     serializer_class = ImageProductSerializer
     permission_classes = [IsAdmin | IsSeller]
@@ -352,18 +434,151 @@ class ProductImageAddView(generics.CreateAPIView):
     
     @swagger_auto_schema(tags=['Product'], consumes=['multipart/form-data'])
     def post(self, request, *args, **kwargs):
-        product_id = self.kwargs.get('pk')
-        product = get_object_or_404(Product, id=product_id, is_deleted=False)
-        if not (request.user.role == 'AD' or request.user.is_staff or product.shop.seller == request.user):
-            return Response(
-                {'detail': 'You do not have permission to add images to this product.'},
-                status=status.HTTP_403_FORBIDDEN
-            )
+        product = get_editable_product(request, self.kwargs.get('pk'))
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save(product_id=product_id)
+        serializer.save(product=product)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+class ProductImageBatchAddView(APIView):
+    permission_classes = [IsAdmin | IsSeller]
+    parser_classes = [MultiPartParser, FormParser]
+
+    @swagger_auto_schema(
+        tags=['Product'],
+        operation_description=f"Add up to {uploads.MAX_FILES} images of at most "
+                              f"{uploads.MAX_FILE_SIZE // 1024 // 1024} MB in one request. "
+                              "Larger files go through image-uploads/.",
+        consumes=['multipart/form-data'],
+        manual_parameters=[
+            openapi.Parameter('images', openapi.IN_FORM, type=openapi.TYPE_ARRAY,
+                              items=openapi.Items(type=openapi.TYPE_FILE), required=True,
+                              collection_format='multi'),
+            openapi.Parameter('main_image', openapi.IN_FORM, type=openapi.TYPE_INTEGER,
+                              description='Position of the image to make the main one'),
+        ],
+        responses={201: ImageProductSerializer(many=True)}
+    )
+    def post(self, request, *args, **kwargs):
+        product = get_editable_product(request, self.kwargs.get('pk'))
+        files = request.FILES.getlist('images')
+        if not files:
+            return Response({'detail': 'No images were uploaded.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(files) > uploads.MAX_FILES:
+            return Response({'detail': f'Upload at most {uploads.MAX_FILES} images at once.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        main_index = request.data.get('main_image')
+        if main_index not in (None, ''):
+            try:
+                main_index = int(main_index)
+            except ValueError:
+                main_index = -1
+            if not 0 <= main_index < len(files):
+                return Response({'main_image': ['Not the position of an uploaded image.']},
+                                status=status.HTTP_400_BAD_REQUEST)
+        else:
+            main_index = None
+
+        errors = {index: f'Images must be at most {uploads.MAX_FILE_SIZE // 1024 // 1024} MB.'
+                  for index, file in enumerate(files) if file.size > uploads.MAX_FILE_SIZE}
+        if not errors:
+            errors = {index: error for index, error in enumerate(uploads.verify_images(files)) if error}
+        if errors:
+            return Response({'images': errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        images = uploads.create_images(product, uploads.store(files), main_index)
+        serializer = ImageProductSerializer(images, many=True, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+class ImageUploadCreateView(generics.CreateAPIView):
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated, IsAdmin | IsSeller]
+    queryset = UploadSession.objects.none()
+
+    @swagger_auto_schema(
+        tags=['Product'],
+        operation_description="Start a resumable upload of a large product image, then PUT its "
+                              "bytes to image-uploads/<id>/?offset=<received> in chunks and POST "
+                              "image-uploads/<id>/complete/."
+    )
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
+        product = get_editable_product(self.request, self.kwargs.get('pk'))
+        serializer.save(user=self.request.user, product=product)
+
+class ImageUploadView(APIView):
+    permission_classes = [permissions.IsAuthenticated, IsAdmin | IsSeller]
+
+    def get_session(self):
+        return get_object_or_404(UploadSession, pk=self.kwargs.get('pk'), user=self.request.user)
+
+    @swagger_auto_schema(tags=['Product'], responses={200: UploadSessionSerializer})
+    def get(self, request, *args, **kwargs):
+        return Response(UploadSessionSerializer(self.get_session()).data)
+
+    @swagger_auto_schema(
+        tags=['Product'],
+        operation_description=f"Append a chunk of at most {uploads.MAX_CHUNK_SIZE // 1024 // 1024} MB "
+                              "sent as the raw request body.",
+        manual_parameters=[
+            openapi.Parameter('offset', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True,
+                              description='Bytes received so far, as returned by the last chunk'),
+        ],
+        responses={200: UploadSessionSerializer}
+    )
+    def put(self, request, *args, **kwargs):
+        session = self.get_session()
+        try:
+            offset = int(request.query_params.get('offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return Response({'detail': 'Send the offset of the chunk.'}, status=status.HTTP_400_BAD_REQUEST)
+        if offset != session.received:
+            return Response({'detail': 'The offset does not match the bytes received.', 'received': session.received},
+                            status=status.HTTP_409_CONFLICT)
+        if not 0 < length <= uploads.MAX_CHUNK_SIZE or offset + length > session.size:
+            return Response({'detail': 'Chunk is empty, too large or past the end of the file.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        received = uploads.write_chunk(session, offset, request.stream, length)
+        if received is None:
+            session.refresh_from_db()
+            return Response({'detail': 'The offset does not match the bytes received.', 'received': session.received},
+                            status=status.HTTP_409_CONFLICT)
+        session.received = received
+        return Response(UploadSessionSerializer(session).data)
+
+    @swagger_auto_schema(tags=['Product'])
+    def delete(self, request, *args, **kwargs):
+        uploads.discard(self.get_session())
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class ImageUploadCompleteView(APIView):
+    permission_classes = [permissions.IsAuthenticated, IsAdmin | IsSeller]
+    parser_classes = [JSONParser, FormParser]
+
+    @swagger_auto_schema(
+        tags=['Product'],
+        request_body=openapi.Schema(type=openapi.TYPE_OBJECT, properties={
+            'is_main_image': openapi.Schema(type=openapi.TYPE_BOOLEAN),
+        }),
+        responses={201: ImageProductSerializer}
+    )
+    def post(self, request, *args, **kwargs):
+        session = get_object_or_404(UploadSession, pk=self.kwargs.get('pk'), user=request.user)
+        session.product = get_editable_product(request, session.product_id)
+        if session.received != session.size:
+            return Response({'detail': 'The upload is not complete.', 'received': session.received},
+                            status=status.HTTP_409_CONFLICT)
+        main = str(request.data.get('is_main_image', '')).lower() in ('1', 'true')
+        image, error = uploads.complete(session, main=main)
+        if error:
+            uploads.discard(session)
+            return Response({'detail': error}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(ImageProductSerializer(image, context={'request': request}).data,
+                        status=status.HTTP_201_CREATED)
+
 class ProductImageDestroyView(generics.DestroyAPIView):
     serializer_class = ImageProductSerializer
     queryset = ImageProduct.objects.all()
@@ -392,17 +607,17 @@ class ProfileInfoView(generics.RetrieveAPIView):
 class CommentsProduct(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = CommentProductSerializer
+    pagination_class = CommentCursorPagination
     
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             return CommentProduct.objects.none()
         product_id = self.kwargs.get('pk')
-        return CommentProduct.objects.filter(product_id=product_id)
+        return CommentProduct.objects.filter(product_id=product_id).select_related('user')
     
     @swagger_auto_schema(tags=['Comments'])
     def get(self, request, *args, **kwargs):
-        serializer = self.get_serializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        return super().get(request, *args, **kwargs)
     
 class CommentsToProduct(generics.CreateAPIView):
     serializer_class = CommentProductSerializer
@@ -457,7 +672,8 @@ class CartListView(generics.ListAPIView):
         if getattr(self, 'swagger_fake_view', False):
             return Cart.objects.none()
         if self.request.user.is_authenticated:
-            return Cart.objects.filter(user=self.request.user, product__is_deleted=False)
+            return (Cart.objects.filter(user=self.request.user, product__is_deleted=False)
+                    .select_related('product', 'reservation'))
         return Cart.objects.none()
     
     @swagger_auto_schema(tags=['Cart'])
@@ -519,6 +735,10 @@ class CartDestroyView(generics.DestroyAPIView):
             return Response({'detail': 'You do not have permission to delete this cart'}, status=status.HTTP_403_FORBIDDEN)
         return super().delete(request, *args, **kwargs)
 
+    def perform_destroy(self, instance):
+        reservations.release([instance])
+        instance.delete()
+
 class CartUpdateView(generics.UpdateAPIView):
     serializer_class = CartSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -565,13 +785,59 @@ class OrderDetailView(generics.RetrieveAPIView):
     @swagger_auto_schema(tags=['Orders'])
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
+class OrderExportView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    outputs = {
+        'csv': (exports.stream_csv, 'text/csv', 'csv'),
+        'ndjson': (exports.stream_ndjson, 'application/x-ndjson', 'ndjson'),
+    }
+
+    @swagger_auto_schema(
+        tags=['Orders'],
+        manual_parameters=[
+            openapi.Parameter('output', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=['csv', 'ndjson']),
+            openapi.Parameter('shop', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Admins only; sellers always get their own shop'),
+            openapi.Parameter('created_after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='ISO date or datetime, inclusive'),
+            openapi.Parameter('created_before', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='ISO date (inclusive) or datetime (exclusive)'),
+        ]
+    )
+    def get(self, request, *args, **kwargs):
+        user = request.user
+        params = request.query_params
+        output = params.get('output', 'csv')
+        if output not in self.outputs:
+            return Response({'detail': 'output must be csv or ndjson.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if user.role == 'AD' or user.is_staff:
+            shop_id = params.get('shop')
+            if shop_id is not None and not shop_id.isdigit():
+                return Response({'detail': 'Invalid shop.'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            shop_id = Shop.objects.filter(seller=user, is_deleted=False).values_list('id', flat=True).first()
+            if shop_id is None:
+                return Response({'detail': 'You do not have a shop.'}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            created_after = params.get('created_after') and exports.parse_moment(params['created_after'])
+            created_before = params.get('created_before') and exports.parse_moment(params['created_before'], end=True)
+        except ValueError:
+            return Response({'detail': 'Invalid date.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = exports.order_items(shop_id, created_after or None, created_before or None)
+        stream, content_type, extension = self.outputs[output]
+        response = StreamingHttpResponse(stream(exports.order_item_rows(queryset)), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="orders.{extension}"'
+        return response
+
 class CreateOrderView(generics.CreateAPIView):
     serializer_class = CreateOrderSerializer
     permission_classes = [permissions.IsAuthenticated]
     queryset = Order.objects.none()
     
     @swagger_auto_schema(tags=['Orders'])
-    @transaction.atomic  
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -642,12 +908,13 @@ class CrownProductView(generics.CreateAPIView):
 class CommentListView(generics.ListAPIView):
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    pagination_class = CommentCursorPagination
     
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             return CommentProduct.objects.none()
         product_id = self.kwargs.get('product_id')
-        return CommentProduct.objects.filter(product_id=product_id)
+        return CommentProduct.objects.filter(product_id=product_id).select_related('user')
     
     @swagger_auto_schema(tags=['Product'],consumes=['multipart/form-data'])
     def get(self, request, *args, **kwargs):
@@ -710,57 +977,67 @@ class MyCommentsListView(generics.ListAPIView):
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
-#
-# from rest_framework.throttling import UserRateThrottle
-# from pgvector.django import L2Distance, CosineDistance
-#
-# class AISearchThrottle(UserRateThrottle):
-#     rate = '3/2m'
-#
-# class AISearchView(APIView):
-#     permission_classes = [permissions.IsAuthenticated]
-#     throttle_classes = [AISearchThrottle]
-#
-#     @swagger_auto_schema(
-#         tags=['AI Search'],
-#         operation_description="Search products by text description using AI embeddings.",
-#         request_body=openapi.Schema(
-#             type=openapi.TYPE_OBJECT,
-#             properties={
-#                 'query': openapi.Schema(type=openapi.TYPE_STRING, description='Text description of the product'),
-#             },
-#             required=['query']
-#         ),
-#         responses={200: ProductSerializer(many=True)}
-#     )
-#     def post(self, request):
-#         from .signals import embedding_model
-#
-#         query_text = request.data.get('query')
-#         if not query_text:
-#             return Response({'detail': 'Query text is required.'}, status=status.HTTP_400_BAD_REQUEST)
-#
-#         if not embedding_model:
-#              return Response({'detail': 'Search service unavailable (Model not loaded).'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-#
-#         try:
-#             query_embedding = embedding_model.encode(query_text)
-#
-#             closest_embeddings = ProductImageEmbedding.objects.order_by(
-#                 CosineDistance('embedding', query_embedding)
-#             )[:10].select_related('product_image__product')
-#             products = []
-#             seen_product_ids = set()
-#
-#             for emb in closest_embeddings:
-#                 product = emb.product_image.product
-#                 if product.id not in seen_product_ids:
-#                     products.append(product)
-#                     seen_product_ids.add(product.id)
-#
-#             serializer = ProductSerializer(products, many=True)
-#             return Response(serializer.data)
-#
-#         except Exception as e:
-#             print(f"AI Search Error: {e}")
-#             return Response({'detail': 'Error processing search.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+class CacheStatsView(APIView):
+    permission_classes = [IsAdminHard]
+    cache_names = ('category_list', 'shop_list', 'shop_detail', 'product_list', 'product_detail')
+
+    @swagger_auto_schema(tags=['Cache'])
+    def get(self, request, *args, **kwargs):
+        return Response(caching.stats(self.cache_names))
+
+
+class VisualSearchThrottle(UserRateThrottle):
+    rate = '30/m'
+
+
+class VisualSearchView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [VisualSearchThrottle]
+    parser_classes = [MultiPartParser, FormParser]
+    default_limit = 10
+    max_limit = 50
+
+    @swagger_auto_schema(
+        tags=['Visual Search'],
+        operation_description="Find products whose images look like an uploaded image or a stored product image.",
+        consumes=['multipart/form-data'],
+        manual_parameters=[
+            openapi.Parameter('image', openapi.IN_FORM, type=openapi.TYPE_FILE,
+                              description='Image to search with'),
+            openapi.Parameter('image_id', openapi.IN_FORM, type=openapi.TYPE_INTEGER,
+                              description='Or the id of a product image'),
+            openapi.Parameter('limit', openapi.IN_FORM, type=openapi.TYPE_INTEGER),
+        ],
+        responses={200: ProductSerializer(many=True)}
+    )
+    def post(self, request, *args, **kwargs):
+        try:
+            limit = min(max(int(request.data.get('limit', self.default_limit)), 1), self.max_limit)
+        except ValueError:
+            limit = self.default_limit
+
+        upload = request.FILES.get('image')
+        exclude_product = None
+        if upload:
+            try:
+                vector, dhash = visual.describe(upload)
+            except (OSError, ValueError):
+                return Response({'detail': 'Upload a valid image.'}, status=status.HTTP_400_BAD_REQUEST)
+        elif request.data.get('image_id'):
+            try:
+                image_id = int(request.data['image_id'])
+            except (TypeError, ValueError):
+                return Response({'image_id': ['A valid integer is required.']}, status=status.HTTP_400_BAD_REQUEST)
+            descriptor = ImageDescriptor.objects.filter(image_id=image_id).select_related('image').first()
+            if descriptor is None:
+                return Response({'detail': 'This image has not been indexed yet.'}, status=status.HTTP_404_NOT_FOUND)
+            vector, dhash = visual.stored(descriptor)
+            exclude_product = descriptor.image.product_id
+        else:
+            return Response({'detail': 'Send an image or an image_id.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        ids = visual.similar_products(vector, dhash, limit, exclude_product=exclude_product)
+        products = Product.objects.select_related('main_image').in_bulk(ids)
+        serializer = ProductSerializer([products[pk] for pk in ids if pk in products], many=True,
+                                       context={'request': request})
+        return Response(serializer.data)
@@ -0,0 +1,391 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection
+from PIL import Image, ImageOps
+
+
+COLOR_BINS = 4  # per RGB channel
+EDGE_BINS = 8  # gradient orientations per cell
+EDGE_CELLS = 2  # per side
+DIM = COLOR_BINS ** 3 + EDGE_BINS * EDGE_CELLS ** 2
+SIDE = 64
+# How much a fully different dHash lowers the similarity of two images.
+HASH_WEIGHT = 0.25
+# Descriptors added since the last index build are scanned directly, up to
+# this many; more than that queues a rebuild instead.
+DELTA_LIMIT = 1000
+# At most one rebuild queued by searches per this many seconds, across processes.
+REBUILD_INTERVAL = 600
+REBUILD_LOCK = 'lock:build_visual_index'
+
+
+def index_dir():
+    return getattr(settings, 'VISUAL_INDEX_DIR', os.path.join(settings.BASE_DIR, 'visual_index'))
+
+
+def describe(fp):
+    """Returns ``(vector, dhash)`` for an image file.
+
+    ``vector`` is a unit float16 vector: the square-rooted RGB color
+    histogram followed by gradient orientation histograms of the four
+    quadrants, so a dot product compares both colors and shapes. ``dhash``
+    is the 64-bit difference hash as a signed integer. Raises ``OSError``
+    or ``ValueError`` for anything that is not a readable image.
+    """
+    try:
+        with Image.open(fp) as image:
+            # Lets JPEG decode straight at a fraction of the full size.
+            image.draft('RGB', (SIDE * 2, SIDE * 2))
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            small = image.resize((SIDE, SIDE), Image.Resampling.BILINEAR)
+    except Image.DecompressionBombError as error:
+        raise ValueError(str(error))
+    gray = small.convert('L')
+
+    pixels = np.asarray(small, dtype=np.int32) // (256 // COLOR_BINS)
+    codes = (pixels[..., 0] * COLOR_BINS + pixels[..., 1]) * COLOR_BINS + pixels[..., 2]
+    color = np.bincount(codes.ravel(), minlength=COLOR_BINS ** 3).astype(np.float32)
+    color = np.sqrt(color / color.sum())
+
+    gy, gx = np.gradient(np.asarray(gray, dtype=np.float32))
+    magnitude = np.hypot(gx, gy)
+    orientation = np.minimum((np.arctan2(gy, gx) % np.pi / np.pi * EDGE_BINS).astype(np.int32), EDGE_BINS - 1)
+    band = np.arange(SIDE) * EDGE_CELLS // SIDE
+    cell = band[:, None] * EDGE_CELLS + band[None, :]
+    edges = np.bincount((cell * EDGE_BINS + orientation).ravel(), weights=magnitude.ravel(),
+                        minlength=EDGE_BINS * EDGE_CELLS ** 2).astype(np.float32)
+    norm = np.linalg.norm(edges)
+    if norm:
+        edges /= norm
+
+    vector = np.concatenate([color, edges]) / np.sqrt(2)
+
+    hash_pixels = np.asarray(gray.resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = np.packbits(hash_pixels[:, 1:] > hash_pixels[:, :-1])
+    return vector.astype(np.float16), int(bits.view('>i8')[0])
+
+
+def stored(descriptor):
+    return np.frombuffer(bytes(descriptor.vector), dtype=np.float16), descriptor.dhash
+
+
+def _scores(vectors, hashes, query, query_hash):
+    similarity = np.asarray(vectors, dtype=np.float32) @ query
+    distance = np.bitwise_count(np.asarray(hashes, dtype=np.uint64) ^ query_hash)
+    return similarity - HASH_WEIGHT * distance / 64
+
+
+def _to_hashes(values):
+    return np.array(values, dtype=np.int64).view(np.uint64)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _assign(vectors, centroids, chunk_size=65536):
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        labels[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def _kmeans(sample, nlist, iterations, rng):
+    # Spherical k-means: centroids stay unit length, like the vectors.
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        labels = _assign(sample, centroids)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=nlist)
+        present = np.flatnonzero(counts)
+        starts = np.r_[0, np.cumsum(counts)[:-1]][present]
+        sums = np.add.reduceat(sample[order].astype(np.float32), starts, axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids[present] = sums / np.maximum(norms, 1e-12)
+    return centroids
+
+
+def build_index(path=None, nlist=None, iterations=8, seed=0):
+    """Writes an IVF index of every stored descriptor and makes it current.
+
+    The vectors are clustered with k-means into ``nlist`` lists and written
+    sorted by list, so a query reads a few contiguous slices of a memory
+    mapped file. A new build goes to its own directory and is switched to
+    by replacing the ``CURRENT`` file, so searches never see a partial one.
+    """
+    from .models import ImageDescriptor
+
+    path = path or index_dir()
+    descriptors = ImageDescriptor.objects.order_by('id')
+    count = descriptors.count()
+    if not count:
+        return 0
+    name = f'build-{time.time_ns()}'
+    build = os.path.join(path, name)
+    os.makedirs(build)
+
+    raw = np.lib.format.open_memmap(os.path.join(build, 'raw.npy'), 'w+', np.float16, (count, DIM))
+    hashes = np.empty(count, dtype=np.uint64)
+    image_ids = np.empty(count, dtype=np.int64)
+    rows = descriptors.values_list('id', 'image_id', 'vector', 'dhash').iterator(chunk_size=5000)
+    filled, max_id = 0, 0
+    for batch in _batches(rows, 5000):
+        # Rows added after the count are left for the next build.
+        batch = batch[:count - filled]
+        end = filled + len(batch)
+        raw[filled:end] = np.frombuffer(b''.join(bytes(row[2]) for row in batch), dtype=np.float16).reshape(-1, DIM)
+        hashes[filled:end] = _to_hashes([row[3] for row in batch])
+        image_ids[filled:end] = [row[1] for row in batch]
+        max_id = batch[-1][0]
+        filled = end
+        if filled == count:
+            break
+    # Rows deleted meanwhile leave the tail unfilled.
+    count = filled
+    if not count:
+        shutil.rmtree(build, ignore_errors=True)
+        return 0
+    raw, hashes, image_ids = raw[:count], hashes[:count], image_ids[:count]
+
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist or int(np.clip(4 * np.sqrt(count), 1, 4096)), count)
+    sample_size = min(count, nlist * 32)
+    sample = np.asarray(raw[np.sort(rng.choice(count, sample_size, replace=False))])
+    centroids = _kmeans(sample, nlist, iterations, rng)
+    labels = _assign(raw, centroids)
+    order = np.argsort(labels, kind='stable')
+
+    vectors = np.lib.format.open_memmap(os.path.join(build, 'vectors.npy'), 'w+', np.float16, (count, DIM))
+    for start in range(0, count, 65536):
+        vectors[start:start + 65536] = raw[order[start:start + 65536]]
+    vectors.flush()
+    del vectors, raw
+    os.remove(os.path.join(build, 'raw.npy'))
+    np.save(os.path.join(build, 'hashes.npy'), hashes[order])
+    np.save(os.path.join(build, 'image_ids.npy'), image_ids[order])
+    np.save(os.path.join(build, 'centroids.npy'), centroids)
+    np.save(os.path.join(build, 'offsets.npy'), np.r_[0, np.cumsum(np.bincount(labels, minlength=nlist))])
+    with open(os.path.join(build, 'meta.json'), 'w') as meta:
+        json.dump({'count': count, 'nlist': nlist, 'max_id': max_id}, meta)
+
+    # Builds can overlap (the nightly command and one queued by searches):
+    # the newest one wins and only older ones are removed.
+    if _build_time(_current_name(path)) > _build_time(name):
+        shutil.rmtree(build, ignore_errors=True)
+        return count
+    with open(os.path.join(path, f'CURRENT.{name}.tmp'), 'w') as current:
+        current.write(name)
+    os.replace(os.path.join(path, f'CURRENT.{name}.tmp'), os.path.join(path, 'CURRENT'))
+    for entry in os.listdir(path):
+        if entry.startswith('build-') and _build_time(entry) < _build_time(name):
+            shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+    return count
+
+
+def _current_name(path):
+    try:
+        with open(os.path.join(path, 'CURRENT')) as current:
+            return current.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _build_time(name):
+    try:
+        return int(name.removeprefix('build-'))
+    except (AttributeError, ValueError):
+        return 0
+
+
+class _LoadedIndex:
+    def __init__(self, path, name):
+        build = os.path.join(path, name)
+        self.name = name
+        self.vectors = np.load(os.path.join(build, 'vectors.npy'), mmap_mode='r')
+        self.hashes = np.load(os.path.join(build, 'hashes.npy'), mmap_mode='r')
+        self.image_ids = np.load(os.path.join(build, 'image_ids.npy'), mmap_mode='r')
+        self.centroids = np.load(os.path.join(build, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(build, 'offsets.npy'))
+        with open(os.path.join(build, 'meta.json')) as meta:
+            self.max_id = json.load(meta)['max_id']
+
+
+class VisualIndex:
+    """k-NN search over image descriptors.
+
+    Reads the current ``build_index`` output memory mapped and scores only
+    the ``nprobe`` lists whose centroids are closest to the query, plus the
+    the newest ``DELTA_LIMIT`` descriptors stored since that build. Once
+    more than that are waiting, a rebuild is started in the background.
+    Each process checks for a newer build every ``reload_interval`` seconds.
+    """
+
+    def __init__(self, path=None, nprobe=16, reload_interval=30):
+        self.path = path
+        self.nprobe = nprobe
+        self.reload_interval = reload_interval
+        self.loaded = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def _current(self):
+        if self.checked_at is not None and time.monotonic() - self.checked_at < self.reload_interval:
+            return self.loaded
+        with self.lock:
+            path = self.path or index_dir()
+            name = _current_name(path)
+            if name is None:
+                self.loaded = None
+            elif self.loaded is None or self.loaded.name != name:
+                try:
+                    self.loaded = _LoadedIndex(path, name)
+                except FileNotFoundError:
+                    # Already replaced by a newer build; seen on the next check.
+                    pass
+            self.checked_at = time.monotonic()
+            return self.loaded
+
+    def search(self, vector, dhash, k=50):
+        """Returns up to ``k`` ``(image id, score)`` pairs, best first."""
+        from .models import ImageDescriptor
+
+        query = np.asarray(vector, dtype=np.float32)
+        query_hash = _to_hashes([dhash])[0]
+        loaded = self._current()
+        ids, scores = [], []
+
+        if loaded is not None:
+            nprobe = min(self.nprobe, len(loaded.centroids))
+            probe = np.argpartition(-(loaded.centroids @ query), nprobe - 1)[:nprobe]
+            for list_id in probe:
+                start, end = loaded.offsets[list_id], loaded.offsets[list_id + 1]
+                if start < end:
+                    ids.append(loaded.image_ids[start:end])
+                    scores.append(_scores(loaded.vectors[start:end], loaded.hashes[start:end], query, query_hash))
+
+        fresh = list(ImageDescriptor.objects.filter(id__gt=loaded.max_id if loaded else 0)
+                     .order_by('-id').values_list('image_id', 'vector', 'dhash')[:DELTA_LIMIT + 1])
+        if len(fresh) > DELTA_LIMIT:
+            fresh = fresh[:DELTA_LIMIT]
+            self.rebuild()
+        if fresh:
+            vectors = np.frombuffer(b''.join(bytes(row[1]) for row in fresh), dtype=np.float16).reshape(-1, DIM)
+            ids.append(np.array([row[0] for row in fresh], dtype=np.int64))
+            scores.append(_scores(vectors, _to_hashes([row[2] for row in fresh]), query, query_hash))
+
+        if not ids:
+            return []
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        if len(ids) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return [(int(image_id), float(score)) for image_id, score in zip(ids[order], scores[order])]
+
+
+    def rebuild(self):
+        """Builds a new index on a background thread, unless one was started recently."""
+        if not cache.add(REBUILD_LOCK, 1, REBUILD_INTERVAL):
+            return
+        threading.Thread(target=self._rebuild, daemon=True).start()
+
+    def _rebuild(self):
+        close_old_connections()
+        try:
+            build_index(self.path)
+            self.checked_at = None
+        except Exception as error:
+            print(f"Visual index build error: {error}")
+        finally:
+            connection.close()
+
+
+def similar_products(vector, dhash, limit=10, exclude_product=None):
+    """Ids of the live products whose images look most like the query, best first."""
+    from .models import ImageProduct
+
+    hits = visual_index.search(vector, dhash, k=limit * 5)
+    products = dict(ImageProduct.objects.filter(pk__in=[image_id for image_id, _ in hits], product__is_deleted=False)
+                    .values_list('id', 'product_id'))
+    ids = []
+    for image_id, _ in hits:
+        product_id = products.get(image_id)
+        if product_id is not None and product_id != exclude_product and product_id not in ids:
+            ids.append(product_id)
+            if len(ids) == limit:
+                break
+    return ids
+
+
+def describe_images(image_ids):
+    """Stores descriptors for the given product images; unreadable files are skipped."""
+    from .models import ImageDescriptor, ImageProduct
+
+    descriptors = []
+    for image in ImageProduct.objects.filter(pk__in=image_ids).only('id', 'image'):
+        try:
+            with image.image.open('rb') as fp:
+                vector, dhash = describe(fp)
+        except (OSError, ValueError):
+            continue
+        descriptors.append(ImageDescriptor(image_id=image.pk, vector=vector.tobytes(), dhash=dhash))
+    ImageDescriptor.objects.bulk_create(descriptors, update_conflicts=True, unique_fields=['image'],
+                                        update_fields=['vector', 'dhash'])
+    return len(descriptors)
+
+
+class DescriptorWorker:
+    """Describes newly uploaded images on a background thread.
+
+    Images queued while the worker is busy are described together. Anything
+    lost with the process is picked up by ``build_visual_index --backfill``.
+    """
+
+    def __init__(self, batch_size=50):
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self, image_id):
+        self.queue.put(image_id)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            close_old_connections()
+            try:
+                describe_images(batch)
+            except Exception as error:
+                print(f"Image descriptor error: {error}")
+            finally:
+                connection.close()
+
+
+visual_index = VisualIndex()
+descriptor_worker = DescriptorWorker()
@@ -101,6 +101,21 @@ DATABASES = {
 }
 
 
+# Cache
+# Cached API payloads are keyed by tag versions stored in the cache itself, so
+# with several worker processes they must share one backend (set REDIS_URL).
+
+REDIS_URL = os.getenv('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -141,6 +156,27 @@ STATIC_ROOT = BASE_DIR / 'static'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploads are stored once per distinct content under media/blobs/, see
+# market/storage.py; run `manage.py sweep_media` periodically.
+STORAGES = {
+    'default': {'BACKEND': 'market.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+# Image similarity index written by `manage.py build_visual_index`.
+VISUAL_INDEX_DIR = os.path.join(BASE_DIR, 'visual_index')
+
+# Resized copies of uploaded images (market/images.py): WEBP or JPEG.
+IMAGE_VARIANT_FORMAT = os.getenv('IMAGE_VARIANT_FORMAT', 'WEBP')
+IMAGE_VARIANT_PROCESSES = int(os.getenv('IMAGE_VARIANT_PROCESSES', '2'))
+
+# Partial files of resumable image uploads (market/uploads.py).
+UPLOAD_SESSION_DIR = os.path.join(BASE_DIR, 'uploads')
+
+# How long adding a product to the cart holds its units (market/reservations.py);
+# run `manage.py release_reservations` every minute or so.
+STOCK_RESERVATION_MINUTES = int(os.getenv('STOCK_RESERVATION_MINUTES', '15'))
+
 
 
 # REST FRAMEWORK  SETTINGS